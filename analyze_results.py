@@ -4,91 +4,201 @@ Delta LinF9 Results Analyzer
 Helper script for analyzing and visualizing Delta LinF9 XGB scoring results
 """
 
+import numpy as np
 import pandas as pd
 import argparse
 import os
 import sys
 from pathlib import Path
-import matplotlib.pyplot as plt
-import seaborn as sns
 
-def load_results(results_file):
-    """Load and validate the results CSV file"""
+# Agg rasterization cost grows with dpi^2; 150 dpi is plenty for on-screen review
+PLOT_DPI = 150
+# Fast zlib level for the PNG output, PIL's optimizer pass is skipped
+PNG_SAVE_KWARGS = {'optimize': False, 'compress_level': 1}
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
+def read_results_csv(results_file):
+    """Read the results CSV with the multithreaded pyarrow parser if available"""
+    try:
+        # xgb_score mixes numbers with FAILED/TIMEOUT markers, read it as text
+        return pd.read_csv(results_file, engine='pyarrow', dtype_backend='pyarrow',
+                           dtype={'xgb_score': 'string[pyarrow]'})
+    except (ImportError, TypeError, ValueError):
+        # pyarrow missing or pandas < 2.0: use the default C engine
+        return pd.read_csv(results_file)
+
+def write_results_csv(df, output_file):
+    """Write a pandas frame to CSV with the pyarrow writer if available"""
+    if pa is None:
+        df.to_csv(output_file, index=False)
+    else:
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), output_file)
+
+def polars_to_pandas(frame):
+    """Convert a polars frame to pandas, also without pyarrow installed"""
     try:
-        df = pd.read_csv(results_file)
+        return frame.to_pandas()
+    except ImportError:
+        # to_pandas needs pyarrow
+        return pd.DataFrame(frame.to_dict(as_series=False))
+
+def load_results(results_file, backend='pandas'):
+    """Load and validate the results CSV file
+
+    Returns the frame the top ligands are exported from together with a
+    pandas frame for the statistics and plots. With the pandas backend both
+    are the same frame, with the polars backend the first is a polars frame.
+    """
+    try:
+        if backend == 'polars':
+            # xgb_score mixes numbers with FAILED/TIMEOUT markers, read it as text instead
+            # of inferring its type from the first rows only
+            results = pl.scan_csv(results_file, schema_overrides={'xgb_score': pl.Utf8}).with_columns(
+                pl.col('xgb_score').cast(pl.Float64, strict=False).alias('xgb_score_numeric')).collect()
+            return results, polars_to_pandas(results)
+        df = read_results_csv(results_file)
         # Convert XGB scores to numeric, handling FAILED/TIMEOUT entries
         df['xgb_score_numeric'] = pd.to_numeric(df['xgb_score'], errors='coerce')
-        return df
+        return df, df
     except Exception as e:
         print(f"Error loading results file: {e}")
         sys.exit(1)
 
-def generate_summary_stats(df):
-    """Generate summary statistics for the XGB scores"""
-    valid_scores = df['xgb_score_numeric'].dropna()
-    
-    if len(valid_scores) == 0:
+# Columns needed for the statistics and plots; everything else is only
+# required for the exported top-N rows.
+SUMMARY_COLUMNS = ['ligand_id', 'processing_time', 'xgb_score_numeric']
+
+def load_results_chunked(results_file, top_n, chunksize=500_000):
+    """Stream the results CSV in chunks to bound peak memory
+
+    Returns a frame holding only SUMMARY_COLUMNS for every ligand, together
+    with the full rows of the running top N ligands.
+    """
+    try:
+        summary_chunks = []
+        top_ligands = None
+        for chunk in pd.read_csv(results_file, chunksize=chunksize):
+            chunk['xgb_score_numeric'] = pd.to_numeric(chunk['xgb_score'], errors='coerce')
+            candidates = chunk.dropna(subset=['xgb_score_numeric']).nlargest(top_n, 'xgb_score_numeric')
+            if top_ligands is not None:
+                candidates = pd.concat([top_ligands, candidates]).nlargest(top_n, 'xgb_score_numeric')
+            top_ligands = candidates
+            summary_chunks.append(chunk[[c for c in SUMMARY_COLUMNS if c in chunk.columns]])
+        if not summary_chunks:
+            return pd.DataFrame(columns=SUMMARY_COLUMNS), pd.DataFrame(columns=SUMMARY_COLUMNS)
+        return pd.concat(summary_chunks, ignore_index=True), top_ligands
+    except Exception as e:
+        print(f"Error loading results file: {e}")
+        sys.exit(1)
+
+def get_valid_scores(df):
+    """Return the mask of rows with a numeric XGB score and the scores of those rows"""
+    scores = df['xgb_score_numeric'].to_numpy(dtype=np.float64, na_value=np.nan)
+    valid_mask = ~np.isnan(scores)
+    return valid_mask, scores[valid_mask]
+
+def generate_summary_stats(scores):
+    """Generate summary statistics for the valid XGB scores"""
+    if len(scores) == 0:
         return "No valid XGB scores found."
     
+    # A single partition-based quantile pass covers min/q25/median/q75/max
+    q_min, q25, median, q75, q_max = np.quantile(scores, [0.0, 0.25, 0.5, 0.75, 1.0])
+    
     stats = {
-        'count': len(valid_scores),
-        'mean': valid_scores.mean(),
-        'std': valid_scores.std(),
-        'min': valid_scores.min(),
-        'max': valid_scores.max(),
-        'median': valid_scores.median(),
-        'q25': valid_scores.quantile(0.25),
-        'q75': valid_scores.quantile(0.75)
+        'count': len(scores),
+        'mean': scores.mean(),
+        'std': scores.std(ddof=1) if len(scores) > 1 else np.nan,
+        'min': q_min,
+        'max': q_max,
+        'median': median,
+        'q25': q25,
+        'q75': q75
     }
     
     return stats
 
-def create_visualizations(df, output_dir):
-    """Create visualizations of the XGB scores"""
-    valid_df = df.dropna(subset=['xgb_score_numeric'])
+def plot_score_histogram(ax, scores):
+    """Draw the histogram of valid XGB scores on the given axes"""
+    ax.hist(scores, bins=20, alpha=0.7, color='skyblue', edgecolor='black')
+    ax.set_xlabel('XGB Score (pK)')
+    ax.set_ylabel('Frequency')
+    ax.set_title('Distribution of XGB Scores')
+    ax.grid(True, alpha=0.3)
+
+def create_visualizations(df, output_dir, valid_mask=None, scores=None):
+    """Create visualizations of the XGB scores
+
+    valid_mask and scores are the output of get_valid_scores and are
+    computed from df when not given.
+    """
+    # Imported lazily so a missing matplotlib only affects the plotting step
+    import matplotlib.pyplot as plt
     
-    if len(valid_df) == 0:
+    if valid_mask is None or scores is None:
+        valid_mask, scores = get_valid_scores(df)
+    plot_file = os.path.join(output_dir, 'xgb_analysis.png')
+    
+    if len(scores) == 0:
         print("No valid scores for visualization")
         # Create empty plot file
         plt.figure(figsize=(8, 6))
         plt.text(0.5, 0.5, 'No valid XGB scores to plot', ha='center', va='center', fontsize=14)
         plt.title('Delta LinF9 XGB Score Analysis - No Data')
-        plot_file = os.path.join(output_dir, 'xgb_analysis.png')
-        plt.savefig(plot_file, dpi=300, bbox_inches='tight')
+        plt.savefig(plot_file, dpi=PLOT_DPI, pil_kwargs=PNG_SAVE_KWARGS)
         plt.close()
         print(f"Empty plot saved to: {plot_file}")
         return
     
     # Set up the plotting style - use a simpler style
     plt.style.use('default')
+    
+    if len(scores) < 2 or 'ligand_id' not in df.columns:
+        # Box plot and scatter plots carry no information here, only draw the histogram
+        fig, ax = plt.subplots(figsize=(8, 6))
+        fig.suptitle('Delta LinF9 XGB Score Analysis', fontsize=16, fontweight='bold')
+        plot_score_histogram(ax, scores)
+        fig.subplots_adjust(left=0.1, right=0.95, bottom=0.1, top=0.85)
+        plt.savefig(plot_file, dpi=PLOT_DPI, pil_kwargs=PNG_SAVE_KWARGS)
+        plt.close()
+        print(f"Visualization saved to: {plot_file}")
+        return
+    
     fig, axes = plt.subplots(2, 2, figsize=(15, 12))
     fig.suptitle('Delta LinF9 XGB Score Analysis', fontsize=16, fontweight='bold')
     
     # 1. Histogram of XGB scores
-    axes[0, 0].hist(valid_df['xgb_score_numeric'], bins=20, alpha=0.7, color='skyblue', edgecolor='black')
-    axes[0, 0].set_xlabel('XGB Score (pK)')
-    axes[0, 0].set_ylabel('Frequency')
-    axes[0, 0].set_title('Distribution of XGB Scores')
-    axes[0, 0].grid(True, alpha=0.3)
+    plot_score_histogram(axes[0, 0], scores)
     
     # 2. Box plot
-    axes[0, 1].boxplot(valid_df['xgb_score_numeric'])
+    axes[0, 1].boxplot(scores)
     axes[0, 1].set_ylabel('XGB Score (pK)')
     axes[0, 1].set_title('XGB Score Box Plot')
     axes[0, 1].grid(True, alpha=0.3)
     
     # 3. Scatter plot: Ligand ID vs XGB Score
-    axes[1, 0].scatter(valid_df['ligand_id'], valid_df['xgb_score_numeric'], alpha=0.6, color='coral')
+    axes[1, 0].scatter(df['ligand_id'].to_numpy()[valid_mask], scores, alpha=0.6, color='coral')
     axes[1, 0].set_xlabel('Ligand ID')
     axes[1, 0].set_ylabel('XGB Score (pK)')
     axes[1, 0].set_title('XGB Score by Ligand ID')
     axes[1, 0].grid(True, alpha=0.3)
     
     # 4. Processing time vs XGB score
-    if 'processing_time' in valid_df.columns:
-        valid_time_df = valid_df.dropna(subset=['processing_time'])
-        if len(valid_time_df) > 0:
-            axes[1, 1].scatter(valid_time_df['processing_time'], valid_time_df['xgb_score_numeric'], 
+    if 'processing_time' in df.columns:
+        times = df['processing_time'].to_numpy(dtype=np.float64, na_value=np.nan)[valid_mask]
+        has_time = ~np.isnan(times)
+        if has_time.any():
+            axes[1, 1].scatter(times[has_time], scores[has_time], 
                              alpha=0.6, color='lightgreen')
             axes[1, 1].set_xlabel('Processing Time (seconds)')
             axes[1, 1].set_ylabel('XGB Score (pK)')
@@ -101,32 +211,51 @@ def create_visualizations(df, output_dir):
         axes[1, 1].text(0.5, 0.5, 'No processing time data available', 
                        ha='center', va='center', transform=axes[1, 1].transAxes)
     
-    plt.tight_layout()
+    # Fixed margins instead of tight_layout/bbox_inches='tight', which need extra render passes
+    fig.subplots_adjust(left=0.07, right=0.97, bottom=0.06, top=0.92, wspace=0.25, hspace=0.3)
     
     # Save the plot
-    plot_file = os.path.join(output_dir, 'xgb_analysis.png')
-    plt.savefig(plot_file, dpi=300, bbox_inches='tight')
+    plt.savefig(plot_file, dpi=PLOT_DPI, pil_kwargs=PNG_SAVE_KWARGS)
     plt.close()
     
     print(f"Visualization saved to: {plot_file}")
 
-def export_top_ligands(df, output_dir, top_n=10):
-    """Export the top N ligands to a separate file"""
-    valid_df = df.dropna(subset=['xgb_score_numeric'])
-    
+def export_top_ligands(df, output_dir, top_n=10, valid_mask=None, scores=None):
+    """Export the top N ligands to a separate file
+
+    For pandas frames, valid_mask and scores are the output of
+    get_valid_scores and are computed from df when not given.
+    """
     output_file = os.path.join(output_dir, f'top_{top_n}_ligands.csv')
     
-    if len(valid_df) > 0:
-        top_ligands = valid_df.nlargest(top_n, 'xgb_score_numeric')
-        top_ligands.to_csv(output_file, index=False)
-        print(f"Top {top_n} ligands exported to: {output_file}")
-        return top_ligands
+    if pl is not None and isinstance(df, (pl.DataFrame, pl.LazyFrame)):
+        # top_k does not keep any order, so the selected rows are ranked afterwards like in the pandas branch
+        top_ligands = (df.lazy().drop_nulls('xgb_score_numeric').top_k(top_n, by='xgb_score_numeric')
+                       .sort('xgb_score_numeric', descending=True, maintain_order=True).collect())
+        if top_ligands.height > 0:
+            top_ligands.write_csv(output_file)
+            print(f"Top {top_n} ligands exported to: {output_file}")
+            return polars_to_pandas(top_ligands)
     else:
-        # Create empty file with headers
-        empty_df = pd.DataFrame(columns=['ligand_id', 'xgb_score', 'processing_time', 'status', 'ligand_file'])
-        empty_df.to_csv(output_file, index=False)
-        print(f"No valid ligands found. Empty file created: {output_file}")
-        return empty_df
+        if valid_mask is None or scores is None:
+            valid_mask, scores = get_valid_scores(df)
+        if len(scores) > 0:
+            # O(n) selection of the top N positions, then sort only those
+            top = np.arange(len(scores))
+            if len(scores) > top_n:
+                top = np.argpartition(-scores, top_n - 1)[:top_n]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            keep = np.flatnonzero(valid_mask)[top]
+            top_ligands = df.iloc[keep]
+            write_results_csv(top_ligands, output_file)
+            print(f"Top {top_n} ligands exported to: {output_file}")
+            return top_ligands
+    
+    # Create empty file with headers
+    empty_df = pd.DataFrame(columns=['ligand_id', 'xgb_score', 'processing_time', 'status', 'ligand_file'])
+    write_results_csv(empty_df, output_file)
+    print(f"No valid ligands found. Empty file created: {output_file}")
+    return empty_df
 
 def main():
     parser = argparse.ArgumentParser(description='Analyze Delta LinF9 XGB scoring results')
@@ -135,9 +264,17 @@ def main():
     parser.add_argument('-t', '--top', type=int, default=10, help='Number of top ligands to export')
     parser.add_argument('--plot', action='store_true', help='Generate visualization plots')
     parser.add_argument('--stats', action='store_true', help='Show detailed statistics')
+    parser.add_argument('--backend', choices=['polars', 'pandas'], default='pandas',
+                        help='Library used to read the results CSV (polars requires the polars package)')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Stream the results CSV with pandas in chunks of this many rows to bound memory usage')
     
     args = parser.parse_args()
     
+    if args.backend == 'polars' and pl is None:
+        print("Warning: polars not available. Falling back to the pandas backend.")
+        args.backend = 'pandas'
+    
     # Validate input file
     if not os.path.exists(args.results_file):
         print(f"Error: Results file not found: {args.results_file}")
@@ -148,18 +285,24 @@ def main():
     
     # Load results
     print(f"Loading results from: {args.results_file}")
-    df = load_results(args.results_file)
+    if args.chunksize:
+        df, results = load_results_chunked(args.results_file, args.top, args.chunksize)
+    else:
+        results, df = load_results(args.results_file, backend=args.backend)
+    
+    # Computed once and shared by the statistics, export and plots
+    valid_mask, scores = get_valid_scores(df)
     
     print(f"Total ligands: {len(df)}")
-    print(f"Successfully scored: {len(df.dropna(subset=['xgb_score_numeric']))}")
-    print(f"Failed: {len(df) - len(df.dropna(subset=['xgb_score_numeric']))}")
+    print(f"Successfully scored: {len(scores)}")
+    print(f"Failed: {len(df) - len(scores)}")
     
     # Generate statistics
     if args.stats:
         print("\n" + "="*50)
         print("STATISTICAL SUMMARY")
         print("="*50)
-        stats = generate_summary_stats(df)
+        stats = generate_summary_stats(scores)
         if isinstance(stats, dict):
             for key, value in stats.items():
                 print(f"{key.upper():12}: {value:.4f}")
@@ -168,7 +311,10 @@ def main():
     
     # Export top ligands
     print(f"\nExporting top {args.top} ligands...")
-    top_ligands = export_top_ligands(df, args.output, args.top)
+    if results is df:
+        top_ligands = export_top_ligands(df, args.output, args.top, valid_mask, scores)
+    else:
+        top_ligands = export_top_ligands(results, args.output, args.top)
     
     if len(top_ligands) > 0:
         print(f"\nTOP {args.top} LIGANDS:")
@@ -181,9 +327,9 @@ def main():
     # Generate plots (always create the PNG file)
     print(f"\nGenerating visualizations...")
     try:
-        create_visualizations(df, args.output)
+        create_visualizations(df, args.output, valid_mask, scores)
     except ImportError:
-        print("Warning: matplotlib/seaborn not available. Creating empty plot file.")
+        print("Warning: matplotlib not available. Creating empty plot file.")
         # Create empty plot file
         plot_file = os.path.join(args.output, 'xgb_analysis.png')
         with open(plot_file, 'w') as f:
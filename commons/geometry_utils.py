@@ -1,4 +1,3 @@
-import copy
 import math
 
 import numpy as np
@@ -94,6 +93,43 @@ def rigid_transform_Kabsch_3D_torch(A, B):
     t = -R @ centroid_A + centroid_B
     return R, t
 
+# R = Bx3x3 rotation matrices
+# t = Bx3x1 column vectors
+# Batched version of rigid_transform_Kabsch_3D_torch: A and B are zero padded Bx3xN stacks and mask (BxN) marks
+# the real points of every sample, so point clouds of different sizes share one SVD call on the device of the inputs.
+def rigid_transform_Kabsch_3D_torch_batch(A, B, mask):
+    assert A.shape == B.shape
+    num_batch, num_rows, num_cols = A.shape
+    if num_rows != 3:
+        raise Exception(f"matrices are not 3xN, they are {num_rows}x{num_cols}")
+    assert mask.shape == (num_batch, num_cols)
+
+    mask = mask[:, None, :].to(A.dtype)
+    counts = mask.sum(dim=2, keepdim=True)
+
+    # find mean column wise over the real points: B x 3 x 1
+    centroid_A = (A * mask).sum(dim=2, keepdim=True) / counts
+    centroid_B = (B * mask).sum(dim=2, keepdim=True) / counts
+
+    # subtract mean, padding stays zero
+    Am = (A - centroid_A) * mask
+    Bm = (B - centroid_B) * mask
+
+    H = Am @ Bm.transpose(1, 2)
+
+    # find rotation
+    U, S, Vt = torch.linalg.svd(H)
+    V = Vt.transpose(1, 2)
+    Ut = U.transpose(1, 2)
+
+    # special reflection case: flip the last singular vector wherever det(R) < 0
+    SS = torch.eye(3, dtype=A.dtype, device=A.device).repeat(num_batch, 1, 1)
+    SS[:, 2, 2] = 1. - 2. * (torch.linalg.det(V @ Ut) < 0).to(A.dtype)
+    R = (V @ SS) @ Ut
+    assert torch.all(torch.abs(torch.linalg.det(R) - 1) < 1e-5)
+
+    t = -R @ centroid_A + centroid_B
+    return R, t
 
 def get_torsions(mol_list):
     atom_counter = 0
@@ -166,7 +202,7 @@ def GetTransformationMatrix(transformations):
 
 
 def apply_changes(mol, values, rotable_bonds):
-    opt_mol = copy.deepcopy(mol)
+    opt_mol = Chem.Mol(mol)
     #     opt_mol = add_rdkit_conformer(opt_mol)
 
     # apply rotations
@@ -221,4 +257,48 @@ def get_dihedral_vonMises(mol, conf, atom_idx, Z):
             v = v + np.matmul(a_mat, s_star)
     v = v / np.linalg.norm(v)
     v = v.reshape(-1)
-    return np.degrees(np.arctan2(v[1], v[0]))
\ No newline at end of file
+    return np.degrees(np.arctan2(v[1], v[0]))
+
+# Vectorized GetDihedralFromPointCloud for a (T, 4) array of atom quartets. The result has the same sign convention as
+# rdMolTransforms.GetDihedralDeg, so it is also used for the conformer dihedrals.
+def GetDihedralsFromPointCloud(Z, quartets):
+    p = Z[quartets]  # T x 4 x 3
+    b = p[:, :-1] - p[:, 1:]
+    b[:, 0] *= -1
+    b1 = b[:, 1]
+    v = np.stack([b[:, 0], b[:, 2]], axis=1)
+    v = v - (np.einsum('tij,tj->ti', v, b1) / np.einsum('ti,ti->t', b1, b1)[:, None])[..., None] * b1[:, None, :]
+    # Normalize vectors
+    v /= np.linalg.norm(v, axis=-1, keepdims=True)
+    b1 = b1 / np.linalg.norm(b1, axis=-1, keepdims=True)
+    x = np.einsum('ti,ti->t', v[:, 0], v[:, 1])
+    m = np.cross(v[:, 0], b1)
+    y = np.einsum('ti,ti->t', m, v[:, 1])
+    return np.degrees(np.arctan2(y, x))
+
+# get_dihedral_vonMises for all torsions of a molecule at once: the (k, i, j, l) neighbour quartets of every torsion
+# are collected first, then all point cloud and conformer dihedrals are computed in one go and summed per torsion.
+# A_transpose_matrix(alpha) @ S_vec(s) is (cos(s - alpha), sin(s - alpha)), so the 2x2 products reduce to a difference of angles.
+def get_dihedrals_vonMises_batch(mol, conf, torsions, Z):
+    Z = np.array(Z)
+    positions = conf.GetPositions()
+    torsion_idx, point_cloud_quartets, conf_quartets_k, conf_quartets_l = [], [], [], []
+    for t, (k_0, i, j, l_0) in enumerate(torsions):
+        i_neighbors = [atom.GetIdx() for atom in mol.GetAtomWithIdx(i).GetNeighbors() if atom.GetIdx() != j]
+        j_neighbors = [atom.GetIdx() for atom in mol.GetAtomWithIdx(j).GetNeighbors() if atom.GetIdx() != i]
+        for k in i_neighbors:
+            for l in j_neighbors:
+                assert k != l
+                torsion_idx.append(t)
+                point_cloud_quartets.append((k, i, j, l))
+                conf_quartets_k.append((k, i, j, k_0))
+                conf_quartets_l.append((l_0, i, j, l))
+
+    point_cloud_quartets, conf_quartets_k, conf_quartets_l = (np.array(q, dtype=np.int64).reshape(-1, 4) for q in
+                                                              (point_cloud_quartets, conf_quartets_k, conf_quartets_l))
+    s_star = GetDihedralsFromPointCloud(Z, point_cloud_quartets)
+    alpha = GetDihedralsFromPointCloud(positions, conf_quartets_k) + GetDihedralsFromPointCloud(positions, conf_quartets_l)
+    delta = np.radians(s_star - alpha)
+    v_cos = np.bincount(torsion_idx, weights=np.cos(delta), minlength=len(torsions))
+    v_sin = np.bincount(torsion_idx, weights=np.sin(delta), minlength=len(torsions))
+    return np.degrees(np.arctan2(v_sin, v_cos))
@@ -0,0 +1,36 @@
+import mmap
+import os
+
+import numpy as np
+
+
+def build_sdf_offsets(sdf_path):
+    """
+    Byte offsets of the records in an SDF file: record i spans offsets[i]:offsets[i+1].
+    """
+    offsets = [0]
+    with open(str(sdf_path), 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = mm.find(b'\n$$$$')
+                while pos != -1:
+                    end = mm.find(b'\n', pos + 5)
+                    end = len(mm) if end == -1 else end + 1
+                    offsets.append(end)
+                    pos = mm.find(b'\n$$$$', end - 1)
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def read_sdf_names(sdf_path, offsets):
+    """
+    Title line (_Name) of every record, read without parsing the molecules.
+    """
+    names = []
+    with open(str(sdf_path), 'rb') as f:
+        if len(offsets) < 2:
+            return names
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start in offsets[:-1].tolist():
+                end = mm.find(b'\n', start)
+                names.append(mm[start:end].decode().rstrip())
+    return names
@@ -1,103 +1,74 @@
 
-import math, random
-import os, shutil
-import matplotlib.pyplot as plt
-from PIL import Image
+import random
+import os
+from functools import lru_cache
 
-from rdkit.Chem.Draw import rdMolDraw2D
-from rdkit.Chem import AllChem
+from rdkit.Chem import AllChem, Draw
 from rdkit import Chem
 
-random_mols = random.randint(1, 200)
-print(random_mols)
-
 # Config:
 images_dir = './output_AURKB'
-write_dir = './OUTPUT_AURKB_pics_only'
-
-if not os.path.exists(write_dir):
-    os.makedirs(write_dir, exist_ok=True)
-
-images_list = os.listdir(images_dir)
-images_list.sort(key=lambda f: int(f.split('_')[-1]))
-for folder in images_list:
-    print(folder)
-    index = folder.split('_')[-1]
-    print(index)
-    # if index in [58, 59]: next
-    for struct in os.listdir(os.path.join(images_dir, folder)):
-        if struct.endswith('.sdf'):
-            # if index == 59: break
-            img_size = (200, 200)
-            supplier = Chem.SDMolSupplier(f'{images_dir}/{folder}/{struct}')
-            for mol in supplier:
-                try:
-                    AllChem.Compute2DCoords(mol)
-                except:
-                    print('Cannot process coordinates')
-                    continue
-                # mol_id = mol.GetProp('_Name')
-                d = rdMolDraw2D.MolDraw2DCairo(*img_size)
-                d.DrawMolecule(mol)
-                d.FinishDrawing()
-                d.WriteDrawingText(f'{index}.png')
-                shutil.move(f'{index}.png', write_dir)
-
-
-# [os.remove(file) for file in os.listdir(images_dir) if file.endswith('.sdf')]
-
-images_dir = write_dir #'/home/luna/Documents/Coding/EquiBind-XAI/onlypics_1k/'
 result_grid_location = '.'
-result_figsize_resolution = 100 #40 # 1 = 100px
-fontsize = 75
-images_list = os.listdir(images_dir)
-images_list.sort(key=lambda f: int(f.split('.')[0]))
-images_count = len(images_list)
-print('Images: ', images_list)
-print('Images count: ', images_count)
-
-# Calculate the grid size:
-grid_size = math.ceil(math.sqrt(25))
-
-# Create plt plot:
-# fig, axes = plt.subplots(grid_size, grid_size, figsize=(result_figsize_resolution, result_figsize_resolution))
-
-
-def plotting(i, images_count):
-
-    plt.clf()
-    fig, axes = plt.subplots(grid_size, grid_size, figsize=(result_figsize_resolution, result_figsize_resolution))
-    current_file_number = 0
-    current_image_number = i
-    for image_filename in images_list[i:i+25]:
-        x_position = current_file_number % grid_size
-        y_position = current_file_number // grid_size
-
-        # plt_image = plt.imread(images_dir + '/' + images_list[current_file_number])
-        im_open = Image.open(images_dir + '/' + images_list[current_image_number])
-        # width, height = im_open.size 
-        # left = 0
-        # top = 0
-        # right = width / 3
-        # bottom = height
-
-        # # takes in (x, y, width, height)
-        # im1 = im_open.crop((left, top, right, bottom))
-        im1 = im_open
-        axes[x_position, y_position].imshow(im1)
-        axes[x_position, y_position].set_title(image_filename, fontdict={'fontsize':fontsize})
-        axes[x_position, y_position].axis('off')
-        print((current_image_number + 1), '/', images_count, ': ', image_filename)
-
-        current_file_number += 1
-        current_image_number += 1
-
-    plt.subplots_adjust(left=0.0, right=1.0, bottom=0.0, top=0.9)
-    plt.savefig(os.path.join(result_grid_location, f'grid{i}_{i+25}.png'))
-
-    return
+img_size = (200, 200)
+grid_size = 5
+mols_per_grid = grid_size * grid_size
+tmp_images_count = 100
 
 
-tmp_images_count = 100
-for i in range(0, tmp_images_count, 25):
-    plotting(i, images_count)
\ No newline at end of file
+@lru_cache(maxsize=None)
+def _sorted_listdir(path):
+    # Ligand folders sorted by their trailing index, returned as (index, name) pairs.
+    # Decorate with the integer index once instead of re-parsing names in the sort key
+    entries = [(int(entry.name.rsplit('_', 1)[-1]), entry.name) for entry in os.scandir(path) if entry.is_dir()]
+    entries.sort()
+    return tuple(entries)
+
+
+def compute_2d_coords(mol):
+    try:
+        AllChem.Compute2DCoords(mol)
+        return True
+    except:
+        print('Cannot process coordinates')
+        return False
+
+
+def load_mols(images_dir):
+    mols = []
+    legends = []
+    for index, folder in _sorted_listdir(images_dir):
+        print(folder)
+        print(index)
+        for struct in os.listdir(os.path.join(images_dir, folder)):
+            if struct.endswith('.sdf'):
+                supplier = Chem.SDMolSupplier(f'{images_dir}/{folder}/{struct}')
+                for mol in supplier:
+                    if mol is None:
+                        continue
+                    mols.append(mol)
+                    legends.append(str(index))
+
+    # Compute2DCoords holds the GIL for molecules this small, so a plain loop is as fast as threads
+    has_coords = [compute_2d_coords(mol) for mol in mols]
+    mols = [mol for mol, ok in zip(mols, has_coords) if ok]
+    legends = [legend for legend, ok in zip(legends, has_coords) if ok]
+    return mols, legends
+
+
+def main():
+    random_mols = random.randint(1, 200)
+    print(random_mols)
+
+    mols, legends = load_mols(images_dir)
+    print('Molecules count: ', len(mols))
+
+    # Render each block of 25 molecules into a single grid image in one RDKit call
+    for i in range(0, min(tmp_images_count, len(mols)), mols_per_grid):
+        img = Draw.MolsToGridImage(mols[i:i+mols_per_grid], molsPerRow=grid_size, subImgSize=img_size,
+                                   legends=legends[i:i+mols_per_grid], useSVG=False)
+        img.save(os.path.join(result_grid_location, f'grid{i}_{i+mols_per_grid}.png'), optimize=False, compress_level=1)
+        print(min(i + mols_per_grid, len(mols)), '/', len(mols))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,28 +7,66 @@ from load_config_paths import PipelinePaths
 
 from rdkit import Chem
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
 
-def merge_sdf_files(input_files, output_file):
-    writer = Chem.SDWriter(str(output_file))
-    for file in input_files:
-        if not os.path.exists(str(file)):
-            print(f"Warning: File {file} does not exist. Skipping...")
-            continue
-        
-        # Get the filename without extension to use as the ligand name
-        file_stem = Path(file).name  #stem  # e.g., "3" from "3.sdf"
-        
-        supp = Chem.SDMolSupplier(str(file))
-        for mol in supp:
-            if mol is not None:
-                # Set the _Name property to the filename (without .sdf extension)
-                mol.SetProp("_Name", file_stem)
-                writer.write(mol)
-            else:
-                print(f"Warning: Could not parse molecule from {file}")
-                
-    print(f"Processed {len([f for f in input_files if os.path.exists(str(f))])} files")
+def _sdf_text(file):
+    # Parse and sanitize one input SDF with RDKit and return its valid molecules re-serialized as SD text;
+    # this is the --validate path, molecules RDKit cannot sanitize are reported and left out
+    # Get the filename without extension to use as the ligand name
+    file_stem = Path(file).name  #stem  # e.g., "3" from "3.sdf"
+
+    buffer = StringIO()
+    writer = Chem.SDWriter(buffer)
+    supp = Chem.SDMolSupplier(file)
+    for mol in supp:
+        if mol is not None:
+            # Set the _Name property to the filename (without .sdf extension)
+            mol.SetProp("_Name", file_stem)
+            writer.write(mol)
+        else:
+            print(f"Warning: Could not parse molecule from {file}")
+    writer.flush()
+    text = buffer.getvalue()
     writer.close()
+    return text
+
+def merge_sdf_files(input_files, output_file):
+    # Parsing is independent per file; only the write has to stay serial to keep the input order
+    with ProcessPoolExecutor() as executor:
+        sdf_texts = list(executor.map(_sdf_text, input_files))
+
+    with open(str(output_file), 'w') as writer:
+        for text in sdf_texts:
+            writer.write(text)
+
+    print(f"Processed {len(input_files)} files")
+
+
+def merge_sdf_files_raw(input_files, output_file, buffer_size=1 << 20):
+    # Text-level concatenation for trusted EquiBind outputs: skips the RDKit parse/sanitize/write
+    # round trip and only rewrites the title line of every record to the input file name, like merge_sdf_files does.
+    with open(output_file, 'wb', buffering=buffer_size) as writer:
+        for file in input_files:
+            file_name = Path(file).name.encode()
+            with open(file, 'rb', buffering=buffer_size) as reader:
+                records = reader.read().split(b'$$$$')
+
+            for i, record in enumerate(records):
+                # drop the line break that followed the previous $$$$ delimiter
+                if i > 0 and record.startswith(b'\r\n'):
+                    record = record[2:]
+                elif i > 0 and record.startswith(b'\n'):
+                    record = record[1:]
+                if not record.strip():
+                    continue
+                _, _, body = record.partition(b'\n')
+                writer.write(file_name + b'\n' + body)
+                if not body.endswith(b'\n'):
+                    writer.write(b'\n')
+                writer.write(b'$$$$\n')
+
+    print(f"Processed {len(input_files)} files")
 
 
 
@@ -44,6 +82,7 @@ if __name__ == '__main__':
     parser.add_argument('--pdbid', type=str, required=False, default='4af3', help='Aurora kinase type (str, A, B)')
     parser.add_argument('--experiment', type=str, required=False, default='default', help='Aurora kinase type (str, A, B)')
     parser.add_argument('--output_file', type=str, required=False, default=None, help='Output file path')
+    parser.add_argument('--validate', action='store_true', help='Parse every ligand with RDKit while merging instead of concatenating the raw SDF text')
     args = parser.parse_args()
 
     epoch = args.epoch
@@ -52,6 +91,7 @@ if __name__ == '__main__':
     aurora = args.aurora
     pdbid = args.pdbid.lower()
     experiment = args.experiment
+    merge = merge_sdf_files if args.validate else merge_sdf_files_raw
 
     # output_csv = paths.output_path(epoch, num_gen, known_binding_site, pdbid, args.output_file) 
     ligands_dir = Path(paths.equibind_ligands_path(experiment, epoch, num_gen, known_binding_site, pdbid))
@@ -60,8 +100,9 @@ if __name__ == '__main__':
     output_sdf = ligands_dir / 'multiligand.sdf'
     print("Output sdf: ", output_sdf)
 
-    # Get all SDF files in the ligands directory
-    sdf_files = list(ligands_dir.glob("*.sdf"))
+    # Get all SDF files in the ligands directory; glob only yields existing files,
+    # so the merge functions take the paths as plain strings without re-checking them
+    sdf_files = [str(p) for p in ligands_dir.glob("*.sdf")]
     
     if not sdf_files:
         print(f"Warning: No SDF files found in {ligands_dir}")
@@ -70,7 +111,7 @@ if __name__ == '__main__':
             f.write("")
     else:
         print(f"Found {len(sdf_files)} SDF files to merge")
-        merge_sdf_files(sdf_files, output_sdf)
+        merge(sdf_files, output_sdf)
 
     print(f"Merged SDF file created: {output_sdf}")
 
@@ -86,7 +127,7 @@ if __name__ == '__main__':
         print("Attempting to create file directly in results directory...")
         try:
             if sdf_files:
-                merge_sdf_files(sdf_files, results_sdf_path)
+                merge(sdf_files, results_sdf_path)
             else:
                 with open(results_sdf_path, 'w') as f:
                     f.write("")
@@ -1,13 +1,18 @@
+import heapq
+
 from torch.utils.data import Dataset
 from commons.process_mols import get_geometry_graph, get_lig_graph_revised, get_rdkit_coords
 from dgl import batch
 from rdkit.Chem import SDMolSupplier, SanitizeMol, SanitizeFlags, PropertyMol, SmilesMolSupplier, AddHs
+try:
+    from rdkit.Chem import MultithreadedSDMolSupplier
+except ImportError:
+    MultithreadedSDMolSupplier = None
 
 
 class Ligands(Dataset):
-    def __init__(self, ligpath, rec_graph, args, lazy = None, slice = None, skips = None, ext = None, addH = None, rdkit_seed = None):
+    def __init__(self, ligpath, args, lazy = None, slice = None, skips = None, ext = None, addH = None, rdkit_seed = None):
         self.ligpath = ligpath
-        self.rec_graph = rec_graph
         self.args = args
         self.dp = args.dataset_params
         self.use_rdkit_coords = args.use_rdkit_coords
@@ -60,14 +65,19 @@ class Ligands(Dataset):
 
         if not self.lazy:
             self.ligs = []
-            for i in range(*self.slice):
+            self.names = []
+            if ext == "sdf" and MultithreadedSDMolSupplier is not None and self.slice == (0, len(self.supplier)):
+                records = self._read_multithreaded()
+            else:
+                records = ((i, self.supplier[i]) for i in range(*self.slice))
+            for i, lig in records:
                 if i in self.skips:
                     continue
-                lig = self.supplier[i]
                 lig, name = self._process(lig)
                 if lig is not None:
                     self.ligs.append(PropertyMol.PropertyMol(lig))
                     self.true_idx.append(i)
+                    self.names.append(self._name(lig, i))
                 else:
                     self.failed_ligs.append((i, name))
 
@@ -76,6 +86,26 @@ class Ligands(Dataset):
         else:
             self._len = len(self.ligs)
 
+    def _read_multithreaded(self):
+        # Parse the whole file on RDKit's C++ reader threads. The threads hand the molecules back in any order, so every
+        # molecule is paired with its record index and held in a small heap until all records before it have arrived;
+        # only the out-of-order window is buffered. Records the supplier never hands back are yielded as unparsable
+        # (None), like the SDMolSupplier path does, so they still end up in failed_ligs.
+        supplier = MultithreadedSDMolSupplier(self.ligpath, numWriterThreads = max(2, self.args.n_workers_data_load),
+                                              sizeInputQueue = 64, sizeOutputQueue = 64, sanitize = False, removeHs = False)
+        pending = []
+        next_idx = 0
+        for lig in supplier:
+            heapq.heappush(pending, (supplier.GetLastRecordId() - 1, lig))
+            while pending and pending[0][0] == next_idx:
+                yield next_idx, heapq.heappop(pending)[1]
+                next_idx += 1
+        for i in range(next_idx, self.slice[1]):
+            if pending and pending[0][0] == i:
+                yield i, heapq.heappop(pending)[1]
+            else:
+                yield i, None
+
     def _process(self, lig):
         if lig is None:
             return None, None
@@ -89,6 +119,30 @@ class Ligands(Dataset):
         else:
             return None, lig.GetProp("_Name")
 
+    def atom_counts(self):
+        # Number of atoms of every sample, used for size-bucketed batching. In lazy mode the counts are read from the
+        # counts line of the raw SDF records without parsing them; SMILES carry no atom count, so None is returned.
+        if not self.lazy:
+            return [lig.GetNumAtoms() for lig in self.ligs]
+        if not isinstance(self.supplier, SDMolSupplier):
+            return None
+        counts = []
+        for true_index in range(*self.slice):
+            if true_index in self.skips:
+                counts.append(0)
+                continue
+            try:
+                counts.append(int(self.supplier.GetItemText(true_index).split("\n")[3][:3]))
+            except (IndexError, ValueError):
+                counts.append(0)
+        return counts
+
+    @staticmethod
+    def _name(lig, true_index):
+        # the ligand name used in the outputs, ligands without a (non-blank) name are named after their index
+        name = lig.GetProp("_Name") if lig.HasProp("_Name") else ""
+        return name if name.strip() else str(true_index)
+
     def __len__(self):
         return self._len
 
@@ -113,22 +167,24 @@ class Ligands(Dataset):
             else:
                 self.failed_ligs.append((true_index, name))
                 return true_index, name
+            name = self._name(lig, true_index)
         elif not self.lazy:
             lig = self.ligs[idx]
             true_index = self.true_idx[idx]
+            name = self.names[idx]
 
         
         try:
-            lig_graph = get_lig_graph_revised(lig, lig.GetProp('_Name'), max_neighbors=self.dp['lig_max_neighbors'],
+            lig_graph = get_lig_graph_revised(lig, name, max_neighbors=self.dp['lig_max_neighbors'],
                                             use_rdkit_coords=self.use_rdkit_coords, radius=self.dp['lig_graph_radius'])
         except AssertionError:
-            self.failed_ligs.append((true_index, lig.GetProp("_Name")))
-            return true_index, lig.GetProp("_Name")
+            self.failed_ligs.append((true_index, name))
+            return true_index, name
         
         geometry_graph = get_geometry_graph(lig) if self.dp['geometry_regularization'] else None
 
         lig_graph.ndata["new_x"] = lig_graph.ndata["x"]
-        return lig, lig_graph.ndata["new_x"], lig_graph, self.rec_graph, geometry_graph, true_index
+        return lig, lig_graph.ndata["new_x"], lig_graph, geometry_graph, true_index, name
     
     @staticmethod
     def collate(_batch):
@@ -138,14 +194,14 @@ class Ligands(Dataset):
         failed_in_batch = tuple(filter(sample_failed, _batch))
         if len(clean_batch) == 0:
             return None, None, None, None, None, None, failed_in_batch
-        ligs, lig_coords, lig_graphs, rec_graphs, geometry_graphs, true_indices = map(list, zip(*clean_batch))
+        ligs, lig_coords, lig_graphs, geometry_graphs, true_indices, names = map(list, zip(*clean_batch))
         output = (
             ligs,
             lig_coords,
             batch(lig_graphs),
-            batch(rec_graphs),
             batch(geometry_graphs) if geometry_graphs[0] is not None else None,
             true_indices,
+            names,
             failed_in_batch
         )
         return output
@@ -1,3 +1,4 @@
+import bisect
 from collections import defaultdict
 from copy import copy, deepcopy
 from typing import List, Optional
@@ -50,3 +51,43 @@ class HardSampler(Sampler[List[int]]):
         # Somewhat related: see NOTE [ Lack of Default `__len__` in Python Abstract Base Classes ]
 
         return len(self.standard_sampler)  # type: ignore
+
+
+class BucketBatchSampler(Sampler[List[int]]):
+    """Batches indices of similarly sized samples together: samples are grouped into buckets by their length
+    (e.g. number of atoms) and every batch is cut once it holds batch_size samples or its summed length would exceed
+    max_tokens (defaults to batch_size times the mean length). Batches are yielded from the smallest bucket on."""
+    def __init__(self, lengths: List[int], batch_size: int, bucket_boundaries=(20, 30, 40, 60, 80, 120),
+                 max_tokens: Optional[int] = None) -> None:
+        super(Sampler, self).__init__()
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.bucket_boundaries = sorted(bucket_boundaries)
+        if max_tokens is None:
+            max_tokens = batch_size * sum(self.lengths) / max(len(self.lengths), 1)
+        self.max_tokens = max_tokens
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        buckets = defaultdict(list)
+        for idx, length in enumerate(self.lengths):
+            buckets[bisect.bisect_left(self.bucket_boundaries, length)].append(idx)
+
+        batches = []
+        for bucket in sorted(buckets):
+            batch, tokens = [], 0
+            for idx in sorted(buckets[bucket], key=self.lengths.__getitem__):
+                if batch and (len(batch) == self.batch_size or tokens + self.lengths[idx] > self.max_tokens):
+                    batches.append(batch)
+                    batch, tokens = [], 0
+                batch.append(idx)
+                tokens += self.lengths[idx]
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
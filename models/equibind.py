@@ -12,6 +12,13 @@ from commons.process_mols import AtomEncoder, rec_atom_feature_dims, rec_residue
 from commons.logger import log
 
 
+class SampleAssertionError(AssertionError):
+    # Raised when the sanity checks fail for one sample of a batch; sample_idx is its position in the batch
+    def __init__(self, message, sample_idx):
+        super(SampleAssertionError, self).__init__(message)
+        self.sample_idx = sample_idx
+
+
 class GraphNorm(nn.Module):
     def __init__(self, num_features, eps=1e-5, affine=True, is_node=True):
         super().__init__()
@@ -746,7 +753,7 @@ class IEGMN(nn.Module):
             else:
                 torch.nn.init.zeros_(p)
 
-    def forward(self, lig_graph, rec_graph, geometry_graph, complex_names, epoch):
+    def forward(self, lig_graph, rec_graph, geometry_graph, complex_names, epoch, rec_precomputed=False):
         orig_coords_lig = lig_graph.ndata['new_x']
         orig_coords_rec = rec_graph.ndata['x']
 
@@ -755,7 +762,9 @@ class IEGMN(nn.Module):
 
         h_feats_lig = self.lig_atom_embedder(lig_graph.ndata['feat'])
 
-        if self.use_rec_atoms:
+        if rec_precomputed:
+            h_feats_rec = rec_graph.ndata['h_pre']  # stored by EquiBind.precompute_receptor
+        elif self.use_rec_atoms:
             h_feats_rec = self.rec_embedder(rec_graph.ndata['feat'])
         else:
             h_feats_rec = self.rec_embedder(rec_graph.ndata['feat'])  # (N_res, emb_dim)
@@ -947,10 +956,10 @@ class IEGMN(nn.Module):
 
             if torch.isnan(lig_keypts).any():
                 log(complex_names, 'complex_names where Nan encountered')
-            assert not torch.isnan(lig_keypts).any()
+                raise SampleAssertionError(f'NaN in the ligand keypoints of sample {idx}', idx)
             if torch.isinf(lig_keypts).any():
                 log(complex_names, 'complex_names where inf encountered')
-            assert not torch.isinf(lig_keypts).any()
+                raise SampleAssertionError(f'inf in the ligand keypoints of sample {idx}', idx)
             ## Apply Kabsch algorithm
             rec_keypts_mean = rec_keypts.mean(dim=0, keepdim=True)  # (1,3)
             lig_keypts_mean = lig_keypts.mean(dim=0, keepdim=True)  # (1,3)
@@ -959,10 +968,10 @@ class IEGMN(nn.Module):
                 self.num_att_heads)  # 3, 3
             if torch.isnan(A).any():
                 log(complex_names, 'complex_names where Nan encountered')
-            assert not torch.isnan(A).any()
+                raise SampleAssertionError(f'NaN in the keypoint covariance of sample {idx}', idx)
             if torch.isinf(A).any():
                 log(complex_names, 'complex_names where inf encountered')
-            assert not torch.isinf(A).any()
+                raise SampleAssertionError(f'inf in the keypoint covariance of sample {idx}', idx)
 
             U, S, Vt = torch.linalg.svd(A)
             num_it = 0
@@ -972,7 +981,7 @@ class IEGMN(nn.Module):
                 A = A + torch.rand(3, 3).to(self.device) * torch.eye(3).to(self.device)
                 U, S, Vt = torch.linalg.svd(A)
                 num_it += 1
-                if num_it > 10: raise Exception('SVD was consitantly unstable')
+                if num_it > 10: raise SampleAssertionError(f'SVD was consitantly unstable for sample {idx}', idx)
 
             corr_mat = torch.diag(torch.tensor([1, 1, torch.sign(torch.det(A))], device=self.device))
             rotation = (U @ corr_mat) @ Vt
@@ -1018,10 +1027,15 @@ class EquiBind(nn.Module):
             else:
                 torch.nn.init.zeros_(p)
 
-    def forward(self, lig_graph, rec_graph, geometry_graph=None, complex_names=None, epoch=0):
+    def precompute_receptor(self, rec_graph):
+        # The receptor node embedding does not depend on the ligand. For a fixed receptor it can be computed once,
+        # stored as rec_graph.ndata['h_pre'] and reused by calling forward with rec_precomputed=True.
+        return self.iegmn.rec_embedder(rec_graph.ndata['feat'])
+
+    def forward(self, lig_graph, rec_graph, geometry_graph=None, complex_names=None, epoch=0, rec_precomputed=False):
         if self.debug: log(complex_names)
         predicted_ligs_coords_list = []
-        outputs = self.iegmn(lig_graph, rec_graph, geometry_graph, complex_names, epoch)
+        outputs = self.iegmn(lig_graph, rec_graph, geometry_graph, complex_names, epoch, rec_precomputed=rec_precomputed)
         evolved_ligs = outputs[4]
         if self.evolve_only:
             return evolved_ligs, outputs[2], outputs[3], outputs[0], outputs[1], outputs[5]
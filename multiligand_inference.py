@@ -1,17 +1,19 @@
 #!/usr/bin/env python
 import argparse
+import csv
+import pickle
 import sys
 import dgl
 
-from copy import deepcopy
 
 import os
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from rdkit import Chem
-from rdkit.Geometry import Point3D
 
-from commons.geometry_utils import rigid_transform_Kabsch_3D, get_torsions, get_dihedral_vonMises, apply_changes
+from commons.geometry_utils import rigid_transform_Kabsch_3D, rigid_transform_Kabsch_3D_torch_batch, get_torsions, get_dihedrals_vonMises_batch, apply_changes
 from commons.process_mols import get_rec_graph, get_receptor_inference
 
 #from train import load_model
@@ -32,10 +34,20 @@ from torch.utils.data import DataLoader
 # turn on for debugging C code like Segmentation Faults
 import faulthandler
 from datasets import multiple_ligands
+from datasets.samplers import BucketBatchSampler
 
 faulthandler.enable()
 
-from models.equibind import EquiBind
+from models.equibind import EquiBind, SampleAssertionError
+
+# allow TF32 matmuls on Ampere and newer GPUs (only available from PyTorch 1.12 on)
+if hasattr(torch, 'set_float32_matmul_precision'):
+    torch.set_float32_matmul_precision('high')
+
+# the argument files only hold plain data, so the (C accelerated where available) safe loader is enough
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+_NOT_GIVEN = object()
 
 def parse_arguments(arglist = None):
     p = argparse.ArgumentParser()    
@@ -50,7 +62,7 @@ def parse_arguments(arglist = None):
                     "If not supplied, it is assumed that a file named 'train_arguments.yaml' is located in the same directory as the model checkpoint")
     p.add_argument('--no_skip', dest = "skip_in_output", action = "store_false", help = 'skip input files that already have corresponding folders in the output directory. Used to resume a large interrupted computation')
     p.add_argument('--batch_size', type=int, default=8, help='samples that will be processed in parallel')
-    p.add_argument("--n_workers_data_load", type = int, default = 0, help = "The number of cores used for loading the ligands and generating the graphs used as input to the model. 0 means run in correct process.")
+    p.add_argument("--n_workers_data_load", type = int, default = max(2, (os.cpu_count() or 1) // 2), help = "The number of cores used for loading the ligands and generating the graphs used as input to the model. 0 means run in correct process. Defaults to half of the available cores (at least 2)")
     p.add_argument('--use_rdkit_coords', action="store_true", help='override the rkdit usage behavior of the used model')
     p.add_argument('--device', type=str, default='cuda', help='What device to train on: cuda or cpu')
     p.add_argument('--seed', type=int, default=1, help='seed for reproducibility')
@@ -59,19 +71,24 @@ def parse_arguments(arglist = None):
     p.add_argument("--lazy_dataload", dest = "lazy_dataload", action="store_true", default = None, help = "Turns on lazy dataloading. If on, will postpone rdkit parsing of each ligand until it is requested.")
     p.add_argument("--no_lazy_dataload", dest = "lazy_dataload", action="store_false", default = None, help = "Turns off lazy dataloading. If on, will postpone rdkit parsing of each ligand until it is requested.")
     p.add_argument("--no_run_corrections", dest = "run_corrections", action = "store_false", help = "possibility of turning off running fast point cloud ligand fitting")
-
-    cmdline_parser = deepcopy(p)
+    p.add_argument("--bucket_by_size", action = "store_true", help = "Batch ligands of similar atom counts together to reduce the size spread within batches. Ligands are then processed (and written) out of input order")
+    p.add_argument("--precision", type = str, default = "fp32", choices = ["fp32", "bf16", "fp16"], help = "Precision of the model forward pass on CUDA. bf16 and fp16 run it under autocast, which is faster on recent GPUs but less accurate")
+    p.add_argument("--compile", action = "store_true", help = "Compile the model with torch.compile (CUDA graphs) before inference. Requires PyTorch >= 2.0 and is ignored otherwise")
+
+    # Parse once with every default replaced by a sentinel to tell the arguments given on the command line
+    # apart from the defaults, then put the real defaults back
+    defaults = {action.dest: action.default for action in p._actions if action.default is not argparse.SUPPRESS}
+    p.set_defaults(**{key: _NOT_GIVEN for key in defaults})
     args = p.parse_args(arglist)
-    clear_defaults = {key: argparse.SUPPRESS for key in args.__dict__}
-    cmdline_parser.set_defaults(**clear_defaults)
-    cmdline_parser._defaults = {}
-    cmdline_args = cmdline_parser.parse_args(arglist)
+    cmdline_args = {key for key, value in args.__dict__.items() if value is not _NOT_GIVEN}
+    for key in args.__dict__.keys() - cmdline_args:
+        setattr(args, key, defaults[key])
 
-    return p.parse_args(arglist), set(cmdline_args.__dict__.keys())
+    return args, cmdline_args
 
 def get_default_args(args, cmdline_args):
     if args.config:
-        config_dict = yaml.load(args.config, Loader=yaml.FullLoader)
+        config_dict = yaml.load(args.config, Loader=YAML_LOADER)
         arg_dict = args.__dict__
         for key, value in config_dict.items():
             if isinstance(value, list):
@@ -92,10 +109,10 @@ def get_default_args(args, cmdline_args):
 
     if args.train_args is None:
         with open(os.path.join(os.path.dirname(args.checkpoint), 'train_arguments.yaml'), 'r') as arg_file:
-            checkpoint_dict = yaml.load(arg_file, Loader=yaml.FullLoader)
+            checkpoint_dict = yaml.load(arg_file, Loader=YAML_LOADER)
     else:
         with open(args.train_args, 'r') as arg_file:
-            checkpoint_dict = yaml.load(arg_file, Loader=yaml.FullLoader)
+            checkpoint_dict = yaml.load(arg_file, Loader=YAML_LOADER)
 
     for key, value in checkpoint_dict.items():
         if (key not in config_dict.keys()) and (key not in cmdline_args):
@@ -111,11 +128,21 @@ def load_rec_and_model(args):
     device = torch.device("cuda:0" if torch.cuda.is_available() and args.device == 'cuda' else "cpu")
     print(f"device = {device}")
     # sys.exit()
-    checkpoint = torch.load(args.checkpoint, map_location=device)
+    # Memory-map the checkpoint and only unpickle plain weights (PyTorch >= 2.1), the parameters then go straight
+    # from the mapped file to the device in model.to() instead of being read into host memory first.
+    # Older PyTorch (TypeError), legacy non-zipfile checkpoints (RuntimeError) and checkpoints holding more than
+    # tensors, e.g. optimizer state or scores (UnpicklingError), are loaded the plain way
+    try:
+        checkpoint = torch.load(args.checkpoint, map_location='cpu', mmap=True, weights_only=True)
+    except (TypeError, RuntimeError, pickle.UnpicklingError):
+        checkpoint = torch.load(args.checkpoint, map_location='cpu')
     dp = args.dataset_params
 
     model = EquiBind(device = device, lig_input_edge_feats_dim = 15, rec_input_edge_feats_dim = 27, **args.model_parameters)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    try:
+        model.load_state_dict(checkpoint['model_state_dict'], assign=True)
+    except TypeError:
+        model.load_state_dict(checkpoint['model_state_dict'])
     model.to(device)
     model.eval()
 
@@ -127,6 +154,13 @@ def load_rec_and_model(args):
                                 surface_graph_cutoff=dp['surface_graph_cutoff'],
                                 surface_mesh_cutoff=dp['surface_mesh_cutoff'],
                                 c_alpha_max_neighbors=dp['c_alpha_max_neighbors'])
+    # the receptor is the same for every ligand, so it is moved to the device and embedded only once
+    rec_graph = rec_graph.to(device)
+    with torch.no_grad():
+        rec_graph.ndata['h_pre'] = model.precompute_receptor(rec_graph)
+
+    if args.compile and device.type == 'cuda' and hasattr(torch, 'compile'):
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
 
     return rec_graph, model
 
@@ -160,182 +194,281 @@ def load_rec_and_model(args):
 #     assert len(predictions) == len(out_ligs)
 #     return out_ligs, out_lig_coords, predictions, successes, failures
 
-# Support for confidence score extraction
-def run_batch(model, ligs, lig_coords, lig_graphs, rec_graphs, geometry_graphs, true_indices):
-    try:
-        # Get model output
-        model_output = model(lig_graphs, rec_graphs, geometry_graphs)
-        
-        # Handle different model output formats
-        if isinstance(model_output, tuple) and len(model_output) >= 6:
-            predictions, ligs_keypts, recs_keypts, rotations, translations, geom_losses = model_output[:6]
-        elif isinstance(model_output, tuple):
-            predictions = model_output[0]
-            ligs_keypts = recs_keypts = rotations = translations = geom_losses = None
+AUTOCAST_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+class ConfidenceBuffers:
+    # Padded (B, K, 3) keypoint stacks, rotations, translations and keypoint mask of the confidence computation. They
+    # are kept across batches and only reallocated when a batch does not fit, so all batches run on the same storage.
+    # Every batch is copied in with a few whole-batch ops (cat into a flat buffer, one scatter into the padded stacks)
+    # instead of per-ligand slice assignments.
+    def __init__(self, compile = False):
+        self.capacity = (0, 0)
+        self.device = None
+        self.dtype = None
+        self.layout = None
+        # the buffer shapes rarely change, so the compiled loss mostly runs as a single specialization
+        if compile and compiled_keypoint_alignment_loss is not None:
+            self.alignment_loss = compiled_keypoint_alignment_loss
         else:
-            predictions = model_output
-            ligs_keypts = recs_keypts = rotations = translations = geom_losses = None
-        
-        # Calculate confidence scores
-        confidence_scores = []
-        if (ligs_keypts is not None and recs_keypts is not None and 
-            rotations is not None and translations is not None):
-            
-            batch_size = len(predictions)
-            for i in range(batch_size):
-                try:
-                    lig_kpt = ligs_keypts[i]
-                    rec_kpt = recs_keypts[i]
-                    rotation = rotations[i]
-                    translation = translations[i]
-                    
-                    # Ensure tensors are 2D
-                    if len(lig_kpt.shape) == 1:
-                        lig_kpt = lig_kpt.unsqueeze(0)
-                    if len(rec_kpt.shape) == 1:
-                        rec_kpt = rec_kpt.unsqueeze(0)
-                    
-                    # Calculate keypoint alignment loss
-                    transformed_lig = (rotation @ lig_kpt.t()).t() + translation
-                    keypoint_alignment_loss = torch.mean(torch.norm(transformed_lig - rec_kpt, dim=1))
-                    
-                    # Handle geometric loss
-                    geom_loss_val = float(geom_losses) if isinstance(geom_losses, (int, float)) else 0.0
-                    
-                    # Combine losses as confidence indicator (higher = more confident)
-                    confidence = -float(keypoint_alignment_loss.cpu()) - geom_loss_val
-                    confidence_scores.append(confidence)
-                        
-                except Exception as e:
-                    print(f"Warning: Could not calculate confidence for ligand {i}: {e}")
-                    confidence_scores.append(0.0)
-        else:
-            # Fallback: use dummy confidence scores
-            confidence_scores = [0.0] * len(predictions)
-        
-        out_ligs = ligs
-        out_lig_coords = lig_coords
-        names = []
-        for i, lig in enumerate(ligs):
-            # Try to get the ligand name, fallback to index-based naming
-            if lig.HasProp("_Name") and lig.GetProp("_Name").strip():
-                name = lig.GetProp("_Name")
+            self.alignment_loss = keypoint_alignment_loss
+
+    def fill(self, ligs_keypts, recs_keypts, rotations, translations):
+        ligs_keypts = [kpt.reshape(-1, 3) for kpt in ligs_keypts]
+        recs_keypts = [kpt.reshape(-1, 3) for kpt in recs_keypts]
+        n_keypts = [len(kpt) for kpt in ligs_keypts]
+        for lig_n, rec_kpt in zip(n_keypts, recs_keypts):
+            if lig_n != len(rec_kpt):
+                raise ValueError(f"ligand keypoints ({lig_n}, 3) and receptor keypoints {tuple(rec_kpt.shape)} do not match")
+        batch_size = len(ligs_keypts)
+        max_keypts = max(n_keypts)
+        total_keypts = sum(n_keypts)
+        device, dtype = ligs_keypts[0].device, ligs_keypts[0].dtype
+
+        if batch_size > self.capacity[0] or max_keypts > self.capacity[1] or (device, dtype) != (self.device, self.dtype):
+            if (device, dtype) == (self.device, self.dtype):
+                self.capacity = (max(batch_size, self.capacity[0]), max(max_keypts, self.capacity[1]))
             else:
-                # Use the true_indices for consistent naming
-                name = f"{true_indices[i]}"
-            names.append(name)
-        
-        successes = list(zip(true_indices, names, confidence_scores))
-        failures = []
-        
-    except AssertionError:
-        # Handle individual processing when batch fails
-        lig_graphs, rec_graphs, geometry_graphs = (dgl.unbatch(lig_graphs),
-        dgl.unbatch(rec_graphs), dgl.unbatch(geometry_graphs))
-        predictions = []
-        out_ligs = []
-        out_lig_coords = []
-        successes = []
-        failures = []
-        confidence_scores = []
-        
-        for lig, lig_coord, lig_graph, rec_graph, geometry_graph, true_index in zip(
-            ligs, lig_coords, lig_graphs, rec_graphs, geometry_graphs, true_indices):
+                self.capacity = (batch_size, max_keypts)
+            self.device, self.dtype = device, dtype
+            self.lig_k = torch.zeros(*self.capacity, 3, device=device, dtype=dtype)
+            self.rec_k = torch.zeros(*self.capacity, 3, device=device, dtype=dtype)
+            self.mask = torch.zeros(*self.capacity, device=device, dtype=dtype)
+            self.R = torch.zeros(self.capacity[0], 3, 3, device=device, dtype=dtype)
+            self.t = torch.zeros(self.capacity[0], 1, 3, device=device, dtype=dtype)
+            # the keypoints of all samples back to back, scattered into the padded stacks with one index_put_
+            self.lig_flat = torch.empty(self.capacity[0] * self.capacity[1], 3, device=device, dtype=dtype)
+            self.rec_flat = torch.empty_like(self.lig_flat)
+            self.layout = None
+
+        # The scatter index and the mask only depend on the keypoint counts, which rarely change between batches
+        if self.layout != n_keypts:
+            counts = torch.tensor(n_keypts, device=device)
+            rows = torch.repeat_interleave(torch.arange(batch_size, device=device), counts)
+            cols = torch.arange(total_keypts, device=device) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+            self.index = (rows, cols)
+            self.lig_k.zero_()
+            self.rec_k.zero_()
+            self.mask.zero_()
+            self.mask.index_put_(self.index, torch.ones((), device=device, dtype=dtype))
+            self.layout = n_keypts
+
+        torch.cat(ligs_keypts, out=self.lig_flat[:total_keypts])
+        torch.cat(recs_keypts, out=self.rec_flat[:total_keypts])
+        self.lig_k.index_put_(self.index, self.lig_flat[:total_keypts])
+        self.rec_k.index_put_(self.index, self.rec_flat[:total_keypts])
+        torch.stack(rotations, out=self.R[:batch_size])
+        torch.stack([translation.reshape(1, 3) for translation in translations], out=self.t[:batch_size])
+        return batch_size
+
+def keypoint_alignment_loss(lig_k, rec_k, R, t, mask):
+    # Mean distance between the transformed ligand keypoints and the receptor keypoints of every sample, computed on
+    # the padded (B, K, 3) stacks at once. Rows past the current batch only hold padding and are sliced off by the caller.
+    transformed_lig = torch.bmm(lig_k, R.transpose(1, 2)) + t
+    dists = torch.norm(transformed_lig - rec_k, dim=-1)
+    return (dists * mask).sum(dim=1) / mask.sum(dim=1)
+
+# keypoint_alignment_loss fused into a couple of kernels by torch.compile (PyTorch >= 2.0), used with --compile.
+# Compilation is lazy and only happens on the first call.
+compiled_keypoint_alignment_loss = (torch.compile(keypoint_alignment_loss, fullgraph=True, dynamic=False)
+                                    if hasattr(torch, 'compile') else None)
+
+def batched_confidence(ligs_keypts, recs_keypts, rotations, translations, geom_losses, buffers):
+    # Keypoint alignment loss of every ligand (negated, so higher = more confident) with a single device sync
+    # for the whole batch instead of one per ligand
+    batch_size = buffers.fill(ligs_keypts, recs_keypts, rotations, translations)
+    alignment_loss = buffers.alignment_loss(buffers.lig_k, buffers.rec_k, buffers.R, buffers.t, buffers.mask)[:batch_size]
+
+    # Handle geometric loss
+    geom_loss_val = float(geom_losses) if isinstance(geom_losses, (int, float)) else 0.0
+    return (-alignment_loss - geom_loss_val).cpu().tolist()
+
+def forward_batch(model, lig_graphs, rec_graphs, geometry_graphs, precision = 'fp32'):
+    with torch.autocast(device_type='cuda', dtype=AUTOCAST_DTYPES.get(precision, torch.bfloat16),
+                        enabled=precision in AUTOCAST_DTYPES):
+        model_output = model(lig_graphs, rec_graphs, geometry_graphs, rec_precomputed='h_pre' in rec_graphs.ndata)
+
+    # Handle different model output formats
+    if isinstance(model_output, tuple) and len(model_output) >= 6:
+        predictions, ligs_keypts, recs_keypts, rotations, translations, geom_losses = model_output[:6]
+        if precision in AUTOCAST_DTYPES:
+            # back to float32 for the corrections and the confidence computation
+            predictions = [prediction.float() for prediction in predictions]
+            ligs_keypts = [lig_kpt.float() for lig_kpt in ligs_keypts]
+            recs_keypts = [rec_kpt.float() for rec_kpt in recs_keypts]
+            rotations = [rotation.float() for rotation in rotations]
+            translations = [translation.float() for translation in translations]
+    elif isinstance(model_output, tuple):
+        predictions = model_output[0]
+        ligs_keypts = recs_keypts = rotations = translations = geom_losses = None
+    else:
+        predictions = model_output
+        ligs_keypts = recs_keypts = rotations = translations = geom_losses = None
+    return predictions, ligs_keypts, recs_keypts, rotations, translations, geom_losses
+
+def unbatch_inputs(lig_graphs, rec_graphs, geometry_graphs, rec_graph = None):
+    # Per-ligand graphs of a batch; the receptor graph is the same for every ligand, so only one is kept
+    lig_graph_list = dgl.unbatch(lig_graphs)
+    geometry_graph_list = dgl.unbatch(geometry_graphs) if geometry_graphs is not None else None
+    if rec_graph is None:
+        rec_graph = dgl.unbatch(rec_graphs)[0]
+    return lig_graph_list, geometry_graph_list, rec_graph
+
+def run_individually(model, ligs, lig_coords, lig_graph_list, rec_graph, geometry_graph_list, true_indices, names, keep,
+                     failures, precision = 'fp32', buffers = None):
+    # Fallback of run_batch: the ligands in keep are run through the model one at a time, a ligand that fails
+    # for any reason is added to failures and the others are still returned
+    if buffers is None:
+        buffers = ConfidenceBuffers()
+    out_ligs, out_lig_coords, predictions, successes, confidence_scores = [], [], [], [], []
+    for i in keep:
+        geometry_graph = geometry_graph_list[i] if geometry_graph_list is not None else None
+        try:
+            prediction, lig_kpt, rec_kpt, rotation, translation, geom_loss = forward_batch(
+                model, lig_graph_list[i], rec_graph, geometry_graph, precision)
+        except Exception as e:
+            failures.append((true_indices[i], names[i]))
+            print(f"Error processing {names[i]}: {e}")
+            continue
+
+        confidence = 0.0
+        if lig_kpt is not None and rec_kpt is not None and rotation is not None and translation is not None:
             try:
-                model_output = model(lig_graph, rec_graph, geometry_graph)
-                
-                if isinstance(model_output, tuple) and len(model_output) >= 6:
-                    pred, lig_kpt, rec_kpt, rotation, translation, geom_loss = model_output[:6]
-                    prediction = pred[0]
-                    
-                    try:
-                        # Calculate confidence for individual ligand
-                        if len(lig_kpt[0].shape) == 1:
-                            lig_kpt_tensor = lig_kpt[0].unsqueeze(0)
-                        else:
-                            lig_kpt_tensor = lig_kpt[0]
-                        
-                        if len(rec_kpt[0].shape) == 1:
-                            rec_kpt_tensor = rec_kpt[0].unsqueeze(0)
-                        else:
-                            rec_kpt_tensor = rec_kpt[0]
-                        
-                        transformed_lig = (rotation[0] @ lig_kpt_tensor.t()).t() + translation[0]
-                        keypoint_alignment_loss = torch.mean(torch.norm(transformed_lig - rec_kpt_tensor, dim=1))
-                        geom_loss_val = float(geom_loss) if isinstance(geom_loss, (int, float, torch.Tensor)) else 0.0
-                        confidence = -float(keypoint_alignment_loss.cpu()) - geom_loss_val
-                    except Exception as e:
-                        print(f"Warning: Could not calculate individual confidence: {e}")
-                        confidence = 0.0
-                else:
-                    prediction = model_output[0][0] if isinstance(model_output, tuple) else model_output[0]
-                    confidence = 0.0
-                
-                out_ligs.append(lig)
-                out_lig_coords.append(lig_coord)
-                predictions.append(prediction)
-                confidence_scores.append(confidence)
-                
-                # Try to get the ligand name, fallback to index-based naming
-                if lig.HasProp("_Name") and lig.GetProp("_Name").strip():
-                    name = lig.GetProp("_Name")
-                else:
-                    name = f"{true_index}"
-                    
-                successes.append((true_index, name, confidence))
-                
+                confidence = batched_confidence(lig_kpt, rec_kpt, rotation, translation, geom_loss, buffers)[0]
             except Exception as e:
-                # Try to get the ligand name, fallback to index-based naming
-                if lig.HasProp("_Name") and lig.GetProp("_Name").strip():
-                    name = lig.GetProp("_Name")
-                else:
-                    name = f"{true_index}"
-                    
-                failures.append((true_index, name))
-                print(f"Error processing {name}: {e}")
-                
-    assert len(predictions) == len(out_ligs) == len(confidence_scores)
+                print(f"Warning: Could not calculate individual confidence: {e}")
+
+        out_ligs.append(ligs[i])
+        out_lig_coords.append(lig_coords[i])
+        predictions.append(prediction[0])
+        confidence_scores.append(confidence)
+        successes.append((true_indices[i], names[i], confidence))
+
     return out_ligs, out_lig_coords, predictions, successes, failures, confidence_scores
 
-def run_corrections(lig, lig_coord, ligs_coords_pred_untuned):
-    input_coords = lig_coord.detach().cpu()
-    prediction = ligs_coords_pred_untuned.detach().cpu()
-    lig_input = deepcopy(lig)
-    conf = lig_input.GetConformer()
-    for i in range(lig_input.GetNumAtoms()):
-        x, y, z = input_coords.numpy()[i]
-        conf.SetAtomPosition(i, Point3D(float(x), float(y), float(z)))
+# Support for confidence score extraction
+def run_batch(model, ligs, lig_coords, lig_graphs, rec_graphs, geometry_graphs, true_indices, names, precision = 'fp32',
+              buffers = None, rec_graph = None):
+    if buffers is None:
+        buffers = ConfidenceBuffers()
+    keep = list(range(len(ligs)))
+    failures = []
+    lig_graph_list = None
+    while True:
+        try:
+            predictions, ligs_keypts, recs_keypts, rotations, translations, geom_losses = forward_batch(
+                model, lig_graphs, rec_graphs, geometry_graphs, precision)
+            break
+        except SampleAssertionError as e:
+            # Drop the ligand that failed and rerun the rest of the batch. The kept ligand graphs are batched again,
+            # the receptor graphs are batched from the single receptor graph when it is given.
+            failed = keep.pop(e.sample_idx)
+            failures.append((true_indices[failed], names[failed]))
+            print(f"Error processing {names[failed]}: {e}")
+            if not keep:
+                return [], [], [], [], failures, []
+            if lig_graph_list is None:
+                lig_graph_list, geometry_graph_list, rec_graph = unbatch_inputs(lig_graphs, rec_graphs, geometry_graphs, rec_graph)
+            lig_graphs = dgl.batch([lig_graph_list[i] for i in keep])
+            if geometry_graph_list is not None:
+                geometry_graphs = dgl.batch([geometry_graph_list[i] for i in keep])
+            rec_graphs = dgl.batch([rec_graph] * len(keep))
+        except AssertionError as e:
+            # Any other failed check of the batched forward pass: the remaining ligands are run one by one
+            print(f"Warning: batch failed ({e}), processing its ligands individually")
+            if lig_graph_list is None:
+                lig_graph_list, geometry_graph_list, rec_graph = unbatch_inputs(lig_graphs, rec_graphs, geometry_graphs, rec_graph)
+            return run_individually(model, ligs, lig_coords, lig_graph_list, rec_graph, geometry_graph_list, true_indices,
+                                    names, keep, failures, precision, buffers)
+
+    # Calculate confidence scores
+    if (ligs_keypts is not None and recs_keypts is not None and 
+        rotations is not None and translations is not None):
+        try:
+            confidence_scores = batched_confidence(ligs_keypts, recs_keypts, rotations, translations, geom_losses, buffers)
+        except Exception as e:
+            print(f"Warning: Could not calculate confidence for batch: {e}")
+            confidence_scores = [0.0] * len(predictions)
+    else:
+        # Fallback: use dummy confidence scores
+        confidence_scores = [0.0] * len(predictions)
 
-    lig_equibind = deepcopy(lig)
-    conf = lig_equibind.GetConformer()
-    for i in range(lig_equibind.GetNumAtoms()):
-        x, y, z = prediction.numpy()[i]
-        conf.SetAtomPosition(i, Point3D(float(x), float(y), float(z)))
+    out_ligs = [ligs[i] for i in keep]
+    out_lig_coords = [lig_coords[i] for i in keep]
+    successes = list(zip([true_indices[i] for i in keep], [names[i] for i in keep], confidence_scores))
+
+    assert len(predictions) == len(out_ligs) == len(confidence_scores)
+    return out_ligs, out_lig_coords, predictions, successes, failures, confidence_scores
 
-    coords_pred = lig_equibind.GetConformer().GetPositions()
+def fit_torsions(lig, lig_coord, ligs_coords_pred_untuned):
+    input_np = lig_coord.detach().cpu().numpy().astype(np.float64, copy=False)
+    lig_input = Chem.Mol(lig)
+    lig_input.GetConformer().SetPositions(input_np)
 
-    Z_pt_cloud = coords_pred
     rotable_bonds = get_torsions([lig_input])
-    new_dihedrals = np.zeros(len(rotable_bonds))
-    for idx, r in enumerate(rotable_bonds):
-        new_dihedrals[idx] = get_dihedral_vonMises(lig_input, lig_input.GetConformer(), r, Z_pt_cloud)
+    if not rotable_bonds:
+        # rigid ligand: there are no torsions to fit, only the rigid alignment onto the prediction is left
+        return lig_input
+
+    # the predicted point cloud is only read, so it is used as a plain array instead of a second molecule copy
+    Z_pt_cloud = ligs_coords_pred_untuned.detach().cpu().numpy().astype(np.float64, copy=False)
+    new_dihedrals = get_dihedrals_vonMises_batch(lig_input, lig_input.GetConformer(), rotable_bonds, Z_pt_cloud)
     optimized_mol = apply_changes(lig_input, new_dihedrals, rotable_bonds)
-    optimized_conf = optimized_mol.GetConformer()
-    coords_pred_optimized = optimized_conf.GetPositions()
-    
-    try:
-        R, t = rigid_transform_Kabsch_3D(coords_pred_optimized.T, coords_pred.T)
-        coords_pred_optimized = (R @ (coords_pred_optimized).T).T + t.squeeze()
-        for i in range(optimized_mol.GetNumAtoms()):
-            x, y, z = coords_pred_optimized[i]
-            optimized_conf.SetAtomPosition(i, Point3D(float(x), float(y), float(z)))
-    except np.linalg.LinAlgError:
-        # If SVD fails, skip the rigid transformation and use the optimized coordinates as-is
-        print("Warning: SVD failed in rigid transformation, using optimized coordinates without alignment")
-        pass
-    
     return optimized_mol
 
+def run_corrections_batch(ligs, lig_coords, predictions, names):
+    # The torsion fit is done per ligand, the rigid alignment onto the predictions is done for the whole batch
+    # with a single stacked SVD on the device of the predictions. Ligands whose correction fails are returned unchanged.
+    opt_mols = list(ligs)
+    fitted, fitted_coords = [], []
+    for i, (lig, lig_coord, prediction, name) in enumerate(zip(ligs, lig_coords, predictions, names)):
+        try:
+            optimized_mol = fit_torsions(lig, lig_coord, prediction)
+        except Exception as e:
+            print(f"Warning: Error in corrections for molecule {name}: {e}")
+            continue
+        opt_mols[i] = optimized_mol
+        fitted.append(i)
+        fitted_coords.append(optimized_mol.GetConformer().GetPositions())
+    if not fitted:
+        return opt_mols
+
+    device = predictions[fitted[0]].device
+    n_atoms = [len(coords) for coords in fitted_coords]
+    A = np.zeros((len(fitted), 3, max(n_atoms)))
+    mask = np.zeros((len(fitted), max(n_atoms)), dtype=bool)
+    for k, (coords, n) in enumerate(zip(fitted_coords, n_atoms)):
+        A[k, :, :n] = coords.T
+        mask[k, :n] = True
+    A = torch.from_numpy(A).to(device)
+    B = torch.zeros_like(A)
+    for k, (i, n) in enumerate(zip(fitted, n_atoms)):
+        B[k, :, :n] = predictions[i].detach().t()
+
+    try:
+        R, t = rigid_transform_Kabsch_3D_torch_batch(A, B, torch.from_numpy(mask).to(device))
+        coords_pred_optimized = (R @ A + t).cpu().numpy()
+    except Exception:
+        # a single ill-conditioned ligand (failed SVD, or NaN/inf predictions tripping the det(R) assert)
+        # fails the whole stacked alignment, so redo them one by one
+        A, B = A.cpu().numpy(), B.cpu().numpy()
+        coords_pred_optimized = A.copy()
+        for k, (i, n) in enumerate(zip(fitted, n_atoms)):
+            try:
+                R, t = rigid_transform_Kabsch_3D(A[k, :, :n], B[k, :, :n])
+                coords_pred_optimized[k, :, :n] = R @ A[k, :, :n] + t
+            except np.linalg.LinAlgError:
+                # If SVD fails, skip the rigid transformation and use the optimized coordinates as-is
+                print("Warning: SVD failed in rigid transformation, using optimized coordinates without alignment")
+            except Exception as e:
+                print(f"Warning: Error in corrections for molecule {names[i]}: {e}")
+                opt_mols[i] = ligs[i]
+
+    for k, (i, n) in enumerate(zip(fitted, n_atoms)):
+        if opt_mols[i] is not ligs[i]:
+            opt_mols[i].GetConformer().SetPositions(np.ascontiguousarray(coords_pred_optimized[k, :, :n].T))
+
+    return opt_mols
+
 # def write_while_inferring(dataloader, model, args):
     
 #     full_output_path = os.path.join(args.output_directory, "output.sdf")
@@ -396,7 +529,7 @@ def run_corrections(lig, lig_coord, ligs_coords_pred_untuned):
 #                     failed_file.write("\n")
 
 # Support for extraction and writing of confidence scores
-def write_while_inferring(dataloader, model, args):
+def write_while_inferring(dataloader, model, rec_graph, args):
     
     full_output_path = os.path.join(args.output_directory, "output.sdf")
     full_failed_path = os.path.join(args.output_directory, "failed.txt")
@@ -404,54 +537,33 @@ def write_while_inferring(dataloader, model, args):
     confidence_scores_path = os.path.join(args.output_directory, "confidence_scores.csv")
 
     w_or_a = "a" if args.skip_in_output else "w"
-    
-    # Initialize confidence scores CSV
-    import pandas as pd
-    confidence_data = []
-    
-    with torch.no_grad(), open(full_output_path, w_or_a) as file, open(
-        full_failed_path, "a") as failed_file, open(full_success_path, w_or_a) as success_file:
-        with Chem.SDWriter(file) as writer:
-            i = 0
-            total_ligs = len(dataloader.dataset)
-            for batch in dataloader:
-                i += args.batch_size
-                print(f"Entering batch ending in index {min(i, total_ligs)}/{len(dataloader.dataset)}")
-                ligs, lig_coords, lig_graphs, rec_graphs, geometry_graphs, true_indices, failed_in_batch = batch
-                
+    buffering = 1024 * 1024
+
+    with torch.no_grad(), open(full_output_path, w_or_a, buffering=buffering) as file, open(
+        full_failed_path, "a", buffering=buffering) as failed_file, open(
+        full_success_path, w_or_a, buffering=buffering) as success_file, open(
+        confidence_scores_path, w_or_a, newline="", buffering=1) as confidence_file:
+        # line buffered, so the scores of an interrupted run survive and a resumed run appends to them
+        confidence_writer = csv.DictWriter(confidence_file, fieldnames=['filename', 'confidence_score', 'status'])
+        if confidence_file.tell() == 0:
+            confidence_writer.writeheader()
+        with Chem.SDWriter(file) as writer, ThreadPoolExecutor(max_workers=1) as executor:
+
+            # Runs on the single background thread: corrects and writes one batch while the next one is inferred.
+            # With one worker the batches are still written in order and only this thread touches the output files.
+            def correct_and_write(failed_in_batch, out_ligs, out_lig_coords, predictions, successes, failures, confidence_scores):
                 for failure in failed_in_batch:
                     if failure[1] == "Skipped":
                         continue
                     failed_file.write(f"{failure[0]} {failure[1]}")
                     failed_file.write("\n")
-                if ligs is None:
-                    continue
-                    
-                lig_graphs = lig_graphs.to(args.device)
-                rec_graphs = rec_graphs.to(args.device)
-                geometry_graphs = geometry_graphs.to(args.device)
-                
-                out_ligs, out_lig_coords, predictions, successes, failures, confidence_scores = run_batch(
-                    model, ligs, lig_coords, lig_graphs, rec_graphs, geometry_graphs, true_indices)
-                
-                # Apply corrections with error handling for SVD convergence issues
-                opt_mols = []
-                correction_failures = []
-                for i, (lig, lig_coord, prediction) in enumerate(zip(out_ligs, out_lig_coords, predictions)):
-                    try:
-                        if args.run_corrections:
-                            opt_mol = run_corrections(lig, lig_coord, prediction)
-                        else:
-                            opt_mol = lig
-                        opt_mols.append(opt_mol)
-                    except np.linalg.LinAlgError as e:
-                        print(f"Warning: SVD did not converge for molecule {lig.GetProp('_Name') if lig.HasProp('_Name') else i}: {e}")
-                        opt_mols.append(lig)
-                        correction_failures.append(f"molecule_{i}_svd_failed")
-                    except Exception as e:
-                        print(f"Warning: Error in corrections for molecule {lig.GetProp('_Name') if lig.HasProp('_Name') else i}: {e}")
-                        opt_mols.append(lig)
-                        correction_failures.append(f"molecule_{i}_correction_failed")
+                if out_ligs is None:
+                    return
+
+                if args.run_corrections:
+                    opt_mols = run_corrections_batch(out_ligs, out_lig_coords, predictions, [success[1] for success in successes])
+                else:
+                    opt_mols = out_ligs
                 
                 # Write molecules and collect confidence data
                 for mol, success, conf_score in zip(opt_mols, successes, confidence_scores):
@@ -467,11 +579,7 @@ def write_while_inferring(dataloader, model, args):
                     else:
                         filename = ligand_name
                     
-                    confidence_data.append({
-                        'filename': filename,
-                        'confidence_score': conf_score,
-                        'status': 'success'
-                    })
+                    confidence_writer.writerow({'filename': filename, 'confidence_score': conf_score, 'status': 'success'})
                 
                 for failure in failures:
                     failed_file.write(f"{failure[0]} {failure[1]}")
@@ -485,17 +593,39 @@ def write_while_inferring(dataloader, model, args):
                     else:
                         filename = ligand_name
                     
-                    confidence_data.append({
-                        'filename': filename,
-                        'confidence_score': None,
-                        'status': 'failed'
-                    })
+                    confidence_writer.writerow({'filename': filename, 'confidence_score': None, 'status': 'failed'})
+
+            i = 0
+            total_ligs = len(dataloader.dataset)
+            rec_graphs = None
+            confidence_buffers = ConfidenceBuffers(compile = args.compile and torch.cuda.is_available() and args.device == 'cuda')
+            in_flight = deque()
+            for batch in dataloader:
+                ligs, lig_coords, lig_graphs, geometry_graphs, true_indices, names, failed_in_batch = batch
+                i += len(failed_in_batch) + (len(ligs) if ligs is not None else 0)
+                print(f"Entering batch ending in index {min(i, total_ligs)}/{len(dataloader.dataset)}")
+                
+                if ligs is None:
+                    in_flight.append(executor.submit(correct_and_write, failed_in_batch, None, None, None, None, None, None))
+                    continue
+                    
+                lig_graphs = lig_graphs.to(args.device)
+                geometry_graphs = geometry_graphs.to(args.device)
+                # Batch the device-resident receptor graph on the device. The model only changes the receptor graph
+                # inside local scopes, so the batched graph is reused for as long as the batch size stays the same.
+                if rec_graphs is None or rec_graphs.batch_size != len(ligs):
+                    rec_graphs = dgl.batch([rec_graph] * len(ligs))
+                
+                batch_output = run_batch(model, ligs, lig_coords, lig_graphs, rec_graphs, geometry_graphs, true_indices, names,
+                                         precision = args.precision, buffers = confidence_buffers, rec_graph = rec_graph)
+                in_flight.append(executor.submit(correct_and_write, failed_in_batch, *batch_output))
+                # keep at most two batches waiting for their corrections, this also re-raises errors from the writer
+                while len(in_flight) > 2:
+                    in_flight.popleft().result()
+            for future in in_flight:
+                future.result()
     
-    # Save confidence scores to CSV
-    if confidence_data:
-        df = pd.DataFrame(confidence_data)
-        df.to_csv(confidence_scores_path, index=False)
-        print(f"Confidence scores saved to: {confidence_scores_path}")
+    print(f"Confidence scores saved to: {confidence_scores_path}")
 
 def main(arglist = None):
     args, cmdline_args = parse_arguments(arglist)
@@ -511,23 +641,35 @@ def main(arglist = None):
     success_path = os.path.join(args.output_directory, "success.txt")
     failed_path = os.path.join(args.output_directory, "failed.txt")
     if os.path.exists(success_path) and os.path.exists(failed_path) and args.skip_in_output:
-        with open(success_path) as successes, open(failed_path) as failures:
-            previous_work = successes.readlines()
-            previous_work += failures.readlines()
-        previous_work = set(map(lambda tup: int(tup.split(" ")[0]), previous_work))
+        previous_work = set()
+        for path in (success_path, failed_path):
+            # only the leading index of every "index name" line is needed
+            with open(path, "rb") as previous_file:
+                previous_work.update(int(line.partition(b" ")[0]) for line in previous_file)
         print(f"Found {len(previous_work)} previously calculated ligands")
     else:
         previous_work = None
     
         
     rec_graph, model = load_rec_and_model(args)
+    if args.precision != "fp32" and not next(model.parameters()).is_cuda:
+        print(f"Mixed precision is only used on CUDA, running the model in fp32 instead of {args.precision}")
+        args.precision = "fp32"
     if args.lig_slice is not None:
         lig_slice = tuple(map(int, args.lig_slice.split(",")))
     else:
         lig_slice = None
     
-    lig_data = multiple_ligands.Ligands(args.ligands_sdf, rec_graph, args, slice = lig_slice, skips = previous_work, lazy = args.lazy_dataload)
-    lig_loader = DataLoader(lig_data, batch_size = args.batch_size, collate_fn = lig_data.collate, num_workers = args.n_workers_data_load)
+    lig_data = multiple_ligands.Ligands(args.ligands_sdf, args, slice = lig_slice, skips = previous_work, lazy = args.lazy_dataload)
+    # let the workers build the graphs of the next batches while the current one is on the GPU
+    loader_kwargs = dict(collate_fn = lig_data.collate, num_workers = args.n_workers_data_load)
+    if args.n_workers_data_load > 0:
+        loader_kwargs.update(prefetch_factor = 4, persistent_workers = True)
+    atom_counts = lig_data.atom_counts() if args.bucket_by_size else None
+    if atom_counts is not None:
+        lig_loader = DataLoader(lig_data, batch_sampler = BucketBatchSampler(atom_counts, args.batch_size), **loader_kwargs)
+    else:
+        lig_loader = DataLoader(lig_data, batch_size = args.batch_size, **loader_kwargs)
 
     full_failed_path = os.path.join(args.output_directory, "failed.txt")
     with open(full_failed_path, "a" if args.skip_in_output else "w") as failed_file:
@@ -535,7 +677,7 @@ def main(arglist = None):
             failed_file.write(f"{failure[0]} {failure[1]}")
             failed_file.write("\n")
     
-    write_while_inferring(lig_loader, model, args)
+    write_while_inferring(lig_loader, model, rec_graph, args)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
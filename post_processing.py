@@ -1,8 +1,9 @@
 import os, argparse
+import numpy as np
 import pandas as pd
 import shutil
+import tempfile
 
-from rdkit import Chem
 
 from pathlib import Path
 import sys
@@ -18,23 +19,36 @@ sys.path.append(str(project_root))
 # except ImportError:
 #     # Fallback imports if scripts not available
 from load_config_paths import PipelinePaths
+from commons.sdf_utils import build_sdf_offsets, read_sdf_names
+
+def read_csv_fast(path, **kwargs):
+    """
+    Read a CSV with the multithreaded pyarrow parser if available.
+    """
+    try:
+        return pd.read_csv(path, engine='pyarrow', **kwargs)
+    except (ImportError, TypeError, ValueError, KeyError):
+        # pyarrow missing or unknown to this pandas: use the default C engine. It also handles a
+        # missing usecols column (an ArrowKeyError with pyarrow), raising the usual ValueError for it
+        return pd.read_csv(path, **kwargs)
 
 def load_confidence_scores(confidence_path):
     """
     Load confidence scores from EquiBind results.
     """
-    if not os.path.exists(confidence_path):
+    # Only the filename and the score are used downstream
+    try:
+        confidence_df = read_csv_fast(confidence_path, usecols=['filename', 'confidence_score'])
+    except FileNotFoundError:
         print(f"Warning: Confidence scores file not found at {confidence_path}")
         return pd.DataFrame()
-    
-    confidence_df = pd.read_csv(confidence_path)
-    
-    # The CSV now already has the filename column, no need to create it
-    # Just ensure we have the expected columns
-    if 'filename' not in confidence_df.columns:
-        print("Warning: confidence_scores.csv missing 'filename' column")
+    except (ValueError, KeyError):
+        print("Warning: confidence_scores.csv missing 'filename' or 'confidence_score' column")
         return pd.DataFrame()
     
+    # Numeric column so ranking compares floats, not objects (unparsable scores become NaN)
+    confidence_df['confidence_score'] = pd.to_numeric(confidence_df['confidence_score'], errors='coerce')
+    
     return confidence_df
 
 def get_top_15_confidence_ligands(confidence_df):
@@ -45,8 +59,8 @@ def get_top_15_confidence_ligands(confidence_df):
         print("Warning: No confidence scores available")
         return pd.DataFrame()
     
-    # Sort by confidence score in descending order (higher confidence is better)
-    top_15 = confidence_df.sort_values(by='confidence_score', ascending=False).head(15)
+    # Highest confidence scores first (higher confidence is better); a partial sort is enough for 15 rows
+    top_15 = confidence_df.nlargest(15, 'confidence_score')
     
     return top_15
 
@@ -58,26 +72,61 @@ def merge_confidence_with_synthesizability(top_15_confidence, synth_path):
         print("Warning: No top confidence ligands available")
         return pd.DataFrame()
     
-    if not os.path.exists(synth_path):
+    # Keep only the first row per filename before joining
+    # (hope-box has multiple Tanimoto scores per ligand), so the join never blows up the frame
+    try:
+        synth_df = read_csv_fast(synth_path)
+    except FileNotFoundError:
         print(f"Warning: Synthesizability scores file not found at {synth_path}")
         return top_15_confidence
+    synth_df = synth_df.drop_duplicates(subset=['filename'], keep='first').set_index('filename')
     
-    synth_df = pd.read_csv(synth_path)
-    
-    # Merge on filename
-    merged_df = pd.merge(top_15_confidence, synth_df, on='filename', how='left')
+    # Left join on the filename index; it keeps the top 15 in descending confidence order
+    merged_df = top_15_confidence.drop_duplicates(subset=['filename'], keep='first').set_index('filename').join(
+        synth_df, how='left').reset_index()
     
-    # Remove duplicates by keeping only the first occurrence of each filename
-    # (This handles the case where hope-box has multiple Tanimoto scores per ligand)
-    merged_df = merged_df.drop_duplicates(subset=['filename'], keep='first')
-    
-    # Sort by confidence score in descending order
-    merged_df = merged_df.sort_values(by='confidence_score', ascending=False)
+    return merged_df
+
+def load_sdf_index(sdf_path):
+    """
+    Record offsets and a {_Name: record index} map of an SDF file.
+    Both are cached next to the SDF as <sdf>.index.npz, so re-runs of the pipeline on the same
+    output skip the scan; the cache is rebuilt when the size or modification time of the SDF changed.
+    """
+    sdf_path = str(sdf_path)
+    cache_path = sdf_path + '.index.npz'
+    sdf_stat = os.stat(sdf_path)
+    # size and mtime in ns: a rewrite within the mtime resolution (or a copy keeping the mtime) almost always changes the size
+    sdf_key = np.array([sdf_stat.st_size, sdf_stat.st_mtime_ns], dtype=np.int64)
     
-    # Ensure we only have 15 ligands
-    merged_df = merged_df.head(15)
+    offsets = None
+    try:
+        with np.load(cache_path) as cache:
+            if np.array_equal(cache['sdf_key'], sdf_key):
+                offsets, names = cache['offsets'], cache['names'].tolist()
+    except (OSError, KeyError, ValueError):
+        # no cache yet, a cache from before the size key, or a damaged one
+        pass
     
-    return merged_df
+    if offsets is None:
+        offsets = build_sdf_offsets(sdf_path)
+        names = read_sdf_names(sdf_path, offsets)
+        # written to a temporary file and renamed, so a concurrent run never reads a half-written cache
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(cache_path), suffix='.tmp',
+                                            dir=os.path.dirname(cache_path) or '.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, sdf_key=sdf_key, offsets=offsets, names=np.array(names, dtype=str))
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            print(f"Warning: Could not cache SDF index at {cache_path}: {e}")
+
+    # like a dict filled while reading the file, the last record with a given name wins
+    return offsets, {name: i for i, name in enumerate(names)}
 
 def copy_top_15_sdf_files(top_15_df, source_sdf_path, dest_dir):
     """
@@ -86,52 +135,38 @@ def copy_top_15_sdf_files(top_15_df, source_sdf_path, dest_dir):
     os.makedirs(dest_dir, exist_ok=True)
     
     copied_files = 0
-    copied_filenames = set()  # Track which filenames we've already copied
     
-    # Read all molecules from output.sdf once
+    # The selected records of output.sdf are located through a byte-offset index
     source_file = Path(source_sdf_path).parent / 'output.sdf'
     
-    if not os.path.exists(source_file):
-        print(f"Error: Source SDF file not found: {source_file}")
-        return 0
-    
     try:
-        # Load all molecules with their names
-        supplier = Chem.SDMolSupplier(str(source_file))
-        mol_dict = {}
-        
-        for mol in supplier:
-            if mol is not None and mol.HasProp('_Name'):
-                mol_name = mol.GetProp('_Name')
-                mol_dict[mol_name] = mol
+        offsets, name_index = load_sdf_index(source_file)
         
-        print(f"Loaded {len(mol_dict)} molecules from {source_file}")
+        print(f"Indexed {len(name_index)} molecules in {source_file}")
         
-        # Copy molecules based on top 15 list
-        for _, row in top_15_df.iterrows():
-            filename = row['filename']
-            
-            # Skip if we've already copied this filename
-            if filename in copied_filenames:
-                continue
-            
-            # Use filename directly as it matches the _Name property in the SDF
-            mol_name = filename
-            
-            if mol_name in mol_dict:
-                mol = mol_dict[mol_name]
-                dest_file = os.path.join(dest_dir, filename)
-                
-                # Write individual molecule to SDF file
-                with Chem.SDWriter(dest_file) as writer:
-                    writer.write(mol)
+        with open(source_file, 'rb') as source:
+            # Copy molecules based on top 15 list, each filename only once
+            for filename in pd.unique(top_15_df['filename'].to_numpy()):
+                # Use filename directly as it matches the _Name property in the SDF
+                mol_name = filename
                 
-                copied_files += 1
-                copied_filenames.add(filename)
-                print(f"Copied molecule '{mol_name}' to {dest_file}")
-            else:
-                print(f"Warning: Molecule '{mol_name}' not found in output.sdf")
+                if mol_name in name_index:
+                    i = name_index[mol_name]
+                    dest_file = os.path.join(dest_dir, filename)
+                    
+                    # Copy the record verbatim: no RDKit parse, coordinates and properties stay byte-identical
+                    source.seek(offsets[i])
+                    with open(dest_file, 'wb') as dest:
+                        dest.write(source.read(offsets[i + 1] - offsets[i]))
+                    
+                    copied_files += 1
+                    print(f"Copied molecule '{mol_name}' to {dest_file}")
+                else:
+                    print(f"Warning: Molecule '{mol_name}' not found in output.sdf")
         
+    except FileNotFoundError:
+        print(f"Error: Source SDF file not found: {source_file}")
+        return 0
     except Exception as e:
         print(f"Error processing {source_file}: {e}")
         return 0
@@ -198,9 +233,10 @@ if __name__ == '__main__':
     vina_ligands_dir = os.path.join(vina_base_dir, "ligands")
     os.makedirs(vina_ligands_dir, exist_ok=True)
     
-    # Copy the CSV file to the base experiment directory (not ligands subdirectory)
+    # Copy the CSV file to the base experiment directory (not ligands subdirectory).
+    # Only the contents are staged: copyfile uses os.sendfile on Linux and skips copy2's copystat
     vina_csv_dest = os.path.join(vina_base_dir, 'top_15_confidence_with_synth.csv')
-    shutil.copy2(output_csv, vina_csv_dest)
+    shutil.copyfile(output_csv, vina_csv_dest)
     print(f"Copied CSV file to Vina directory: {vina_csv_dest}")
 
     # Step 4.6: Copy the PDB file to the Vina-box base directory for the protein
@@ -213,18 +249,25 @@ if __name__ == '__main__':
     pdb_dest = os.path.join(vina_protein_dir, f"{pdbid}_A_rec_reduce_noflip.pdb")
 
     try:
-        if os.path.exists(pdb_source):
-            shutil.copy2(pdb_source, pdb_dest)
+        try:
+            shutil.copyfile(pdb_source, pdb_dest)
             print(f"Copied PDB file to Vina directory: {pdb_dest}")
-        else:
+        except FileNotFoundError:
             print(f"Warning: PDB source file not found: {pdb_source}")
             # Fallback: try to find it in any experiment directory
-            search_pattern = os.path.join(paths.project_root, f"external/equibind/data/{pdbid}/*/ligands/{pdbid}_A_rec_reduce_noflip.pdb")
-            import glob
-            matching_files = glob.glob(search_pattern)
-            if matching_files:
-                pdb_source = matching_files[0]  # Use the first match
-                shutil.copy2(pdb_source, pdb_dest)
+            # (one directory level, probing the expected path and stopping at the first hit)
+            pdb_source = None
+            search_dir = os.path.join(paths.project_root, "external", "equibind", "data", pdbid)
+            if os.path.isdir(search_dir):
+                with os.scandir(search_dir) as entries:
+                    for entry in entries:
+                        candidate = os.path.join(entry.path, "ligands", f"{pdbid}_A_rec_reduce_noflip.pdb")
+                        # like the former glob pattern, hidden directories are not searched
+                        if not entry.name.startswith('.') and entry.is_dir() and os.path.isfile(candidate):
+                            pdb_source = candidate
+                            break
+            if pdb_source:
+                shutil.copyfile(pdb_source, pdb_dest)
                 print(f"Found and copied PDB file from: {pdb_source} to {pdb_dest}")
             else:
                 print(f"Error: Could not find PDB file for {pdbid}")
@@ -6,46 +6,79 @@ Processes EquiBind output ligands through Delta LinF9 XGB scoring and ranks them
 
 import os
 import sys
+import csv
 import subprocess
 import pandas as pd
 import argparse
 import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 import tempfile
+import shutil
 import re
+import io
+import mmap
+import contextlib
+import runpy
 import numpy as np
 from rdkit import Chem
-from rdkit.Chem import Descriptors
+from rdkit.Chem import Descriptors, rdMolDescriptors
+
+from commons.sdf_utils import build_sdf_offsets
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+# Colored "[LEVEL] timestamp - message" lines on stdout, rendered by the logging module.
+# DEBUG records are dropped by the level check unless --debug is given.
+logger = logging.getLogger("process_equibind_delta")
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter('%(color)s[%(level)s]\033[0m %(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+logger.addHandler(_handler)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+LOG_LEVELS = {'INFO': logging.INFO, 'WARN': logging.WARNING, 'ERROR': logging.ERROR, 'DEBUG': logging.DEBUG}
+LOG_COLORS = {
+    'INFO': '\033[0;32m',
+    'WARN': '\033[1;33m',
+    'ERROR': '\033[0;31m',
+    'DEBUG': '\033[0;34m'
+}
 
 def log(level, message):
     """Simple logging function"""
-    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-    colors = {
-        'INFO': '\033[0;32m',
-        'WARN': '\033[1;33m', 
-        'ERROR': '\033[0;31m',
-        'DEBUG': '\033[0;34m'
-    }
-    reset = '\033[0m'
-    color = colors.get(level, '')
-    print(f"{color}[{level}]{reset} {timestamp} - {message}")
+    logger.log(LOG_LEVELS.get(level, logging.INFO), message, extra={'level': level, 'color': LOG_COLORS.get(level, '')})
 
 # Global variable for debug mode
 DEBUG_MODE = False
 
+# Descriptors.MolWt only wraps this C++ function in a Python lambda
+CalcMolWt = getattr(rdMolDescriptors, '_CalcMolWt', Descriptors.MolWt)
+# Bound once, they are called for every ligand of the split
+MolFromMolBlock = Chem.MolFromMolBlock
+MolToPDBFile = Chem.MolToPDBFile
+
 def read_success_file(success_file):
-    """Read the success.txt file and return list of successful ligand IDs"""
-    ligand_ids = []
+    """Read the success.txt file and return the set of successful ligand IDs (None if there is no such file)"""
     try:
-        with open(success_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line.isdigit():
-                    ligand_ids.append(int(line))
-        return ligand_ids
+        # The ID is the first column ("<index> <name>" lines as written by multiligand_inference.py),
+        # parsed in C rather than line by line in Python. Malformed lines (a truncated last line,
+        # a non-integer ID) come out as NaN and are skipped, the other IDs are still used for filtering
+        ids = np.genfromtxt(success_file, usecols=0, invalid_raise=False, comments=None, ndmin=1)
+        valid = ids == np.trunc(ids)
+        if not valid.all():
+            log("WARN", f"Skipped {np.count_nonzero(~valid)} malformed lines in {success_file}")
+        # A set, so split_multiligand_sdf checks each molecule in O(1)
+        return set(ids[valid].astype(np.int64).tolist())
+    except FileNotFoundError:
+        return None
     except Exception as e:
         log("ERROR", f"Failed to read success file: {e}")
-        return []
+        return set()
 
 def is_valid_molecule(mol):
     """Check if a molecule has valid coordinates and structure"""
@@ -61,87 +94,221 @@ def is_valid_molecule(mol):
         if mol.GetNumConformers() == 0:
             return False, "No conformer"
         
-        conf = mol.GetConformer()
+        # All coordinates as one (N, 3) array instead of a Python call per atom
+        coords = mol.GetConformer().GetPositions()
         
         # Check for NaN coordinates
-        for i in range(mol.GetNumAtoms()):
-            pos = conf.GetAtomPosition(i)
-            if np.isnan(pos.x) or np.isnan(pos.y) or np.isnan(pos.z):
-                return False, "NaN coordinates"
+        if np.isnan(coords).any():
+            return False, "NaN coordinates"
         
         # Check for zero coordinates (might indicate bad structure)
-        all_zero = True
-        for i in range(mol.GetNumAtoms()):
-            pos = conf.GetAtomPosition(i)
-            if abs(pos.x) > 0.001 or abs(pos.y) > 0.001 or abs(pos.z) > 0.001:
-                all_zero = False
-                break
-        
-        if all_zero:
+        if not (np.abs(coords) > 0.001).any():
             return False, "All coordinates are zero"
         
-        # Check molecular weight (should be reasonable)
-        mw = Descriptors.MolWt(mol)
-        if mw < 50 or mw > 2000:
-            return False, f"Unreasonable molecular weight: {mw:.1f}"
-        
         # Check for reasonable coordinate range
-        min_coord = float('inf')
-        max_coord = float('-inf')
-        
-        for i in range(mol.GetNumAtoms()):
-            pos = conf.GetAtomPosition(i)
-            for coord in [pos.x, pos.y, pos.z]:
-                min_coord = min(min_coord, coord)
-                max_coord = max(max_coord, coord)
-        
-        coord_range = max_coord - min_coord
+        coord_range = coords.max() - coords.min()
         if coord_range > 1000:  # Very spread out coordinates
             return False, f"Coordinates too spread out: {coord_range:.1f}"
         
+        # Check molecular weight (should be reasonable); last, as it is the only check that walks the atoms again
+        mw = CalcMolWt(mol)
+        if mw < 50 or mw > 2000:
+            return False, f"Unreasonable molecular weight: {mw:.1f}"
+        
         return True, "Valid"
         
     except Exception as e:
         return False, f"Error checking molecule: {e}"
 
-def split_multiligand_sdf(sdf_file, output_dir, success_ids=None):
+def write_sdf_records(sdf_file, records):
+    """Copy (start, end, ligand_file) byte ranges of an SDF file to individual files"""
+    # The records are written straight out of the page cache through a memoryview of the mapping
+    with open(sdf_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, end, ligand_file in records:
+            with open(ligand_file, 'wb') as out, memoryview(mm)[start:end] as record:
+                out.write(record)
+
+def split_multiligand_sdf_raw(sdf_file, output_dir, success_ids=None, jobs=None):
+    """Split a multi-ligand SDF file into individual SDF files by byte ranges, without RDKit"""
+    
+    try:
+        offsets = build_sdf_offsets(sdf_file)
+        ligand_files = []
+        records = []
+        
+        for i in range(len(offsets) - 1):
+            # If success_ids is provided, only process successful ligands
+            if success_ids is not None and i not in success_ids:
+                continue
+            
+            # The record is copied verbatim, runXGB.py reads SDF ligands as well as PDB ones
+            ligand_file = os.path.join(output_dir, f"ligand_{i}.sdf")
+            ligand_files.append((i, ligand_file))
+            records.append((int(offsets[i]), int(offsets[i + 1]), ligand_file))
+        
+        # The copies are independent, so they are written in contiguous shards from several threads
+        # (file I/O releases the GIL); each shard opens the SDF once
+        jobs = jobs or os.cpu_count()
+        shard_size = -(-len(records) // jobs) or 1
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(write_sdf_records, [sdf_file] * jobs,
+                              [records[k:k + shard_size] for k in range(0, len(records), shard_size)]))
+        
+        log("INFO", f"Processed {len(offsets) - 1} total structures")
+        log("INFO", f"Created {len(ligand_files)} individual SDF files (not validated)")
+        
+        if len(ligand_files) == 0:
+            log("ERROR", "No ligand structures found!")
+        
+        return ligand_files
+        
+    except FileNotFoundError:
+        log("ERROR", f"Multi-ligand SDF file not found: {sdf_file}")
+        return []
+    except Exception as e:
+        log("ERROR", f"Failed to split multi-ligand SDF: {e}")
+        return []
+
+def validate_and_write_ligand(molblock, ligand_file):
+    """Parse one MOL block, validate it and write it as PDB; returns (is_valid, written, reason)"""
+    mol = MolFromMolBlock(molblock, removeHs=False)
+    
+    # Validate molecule structure
+    is_valid, reason = is_valid_molecule(mol)
+    if not is_valid:
+        return False, False, reason
+    
+    # Convert SDF to PDB using RDKit
+    try:
+        MolToPDBFile(mol, ligand_file)
+    except Exception as e:
+        return True, False, str(e)
+    return True, True, reason
+
+def split_multiligand_sdf_parallel(sdf_file, output_dir, success_ids=None, jobs=None):
+    """Split a multi-ligand SDF file into validated PDB files, parsing the ligands in worker processes"""
+    
+    try:
+        # The parent only slices the raw records out of the file, the workers parse, validate and write them
+        offsets = build_sdf_offsets(sdf_file)
+        total_processed = len(offsets) - 1
+        
+        # If success_ids is provided, only process successful ligands
+        if success_ids is None:
+            selected = range(total_processed)
+        else:
+            selected = sorted(i for i in success_ids if 0 <= i < total_processed)
+        
+        def molblocks():
+            if not selected:
+                return
+            with open(sdf_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for i in selected:
+                    yield mm[offsets[i]:offsets[i + 1]].decode()
+        
+        # Create individual PDB file for each ligand (not SDF)
+        candidate_files = [os.path.join(output_dir, f"ligand_{i}.pdb") for i in selected]
+        ligand_files = []
+        valid_structures = 0
+        
+        with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            results = executor.map(validate_and_write_ligand, molblocks(), candidate_files, chunksize=16)
+            
+            for i, ligand_file, (is_valid, written, reason) in zip(selected, candidate_files, results):
+                if not is_valid:
+                    log("WARN", f"Skipping ligand {i}: {reason}")
+                    continue
+                
+                valid_structures += 1
+                
+                if written:
+                    ligand_files.append((i, ligand_file))
+                    if DEBUG_MODE:
+                        log("DEBUG", f"Extracted valid ligand {i} to {ligand_file}")
+                else:
+                    log("WARN", f"Failed to convert molecule {i} to PDB: {reason}")
+        
+        log("INFO", f"Processed {total_processed} total structures")
+        log("INFO", f"Found {valid_structures} valid structures")
+        log("INFO", f"Created {len(ligand_files)} individual PDB files")
+        
+        if len(ligand_files) == 0:
+            log("ERROR", "No valid ligand structures found!")
+        
+        return ligand_files
+        
+    except FileNotFoundError:
+        log("ERROR", f"Multi-ligand SDF file not found: {sdf_file}")
+        return []
+    except Exception as e:
+        log("ERROR", f"Failed to split multi-ligand SDF: {e}")
+        return []
+
+# Below this size the worker startup costs more than parsing the ligands in this process
+PARALLEL_SPLIT_MIN_BYTES = 16 * 1024 * 1024
+
+def use_parallel_split(sdf_file, jobs=None):
+    """Parse the ligands in worker processes if asked to with -j, or by default for large SDF files"""
+    if jobs is not None:
+        return jobs > 1
+    try:
+        return os.cpu_count() > 1 and os.path.getsize(sdf_file) >= PARALLEL_SPLIT_MIN_BYTES
+    except OSError:
+        # a missing file is reported by the split itself
+        return False
+
+def split_multiligand_sdf(sdf_file, output_dir, success_ids=None, validate=True, jobs=None):
     """Split a multi-ligand SDF file into individual ligand files"""
     
+    if not validate:
+        return split_multiligand_sdf_raw(sdf_file, output_dir, success_ids, jobs)
+    if use_parallel_split(sdf_file, jobs):
+        return split_multiligand_sdf_parallel(sdf_file, output_dir, success_ids, jobs)
+    
     try:
         # Read the multi-ligand SDF file
-        suppl = Chem.SDMolSupplier(sdf_file, removeHs=False)
         ligand_files = []
         total_processed = 0
         valid_structures = 0
         
-        for i, mol in enumerate(suppl):
-            total_processed += 1
-            
-            # If success_ids is provided, only process successful ligands
-            if success_ids is not None and i not in success_ids:
-                continue
+        with contextlib.ExitStack() as stack:
+            if success_ids is None:
+                # One sequential pass over every record: stream it through a forward supplier
+                # that reads the file 64 KiB at a time
+                sdf_stream = stack.enter_context(open(sdf_file, 'rb', buffering=65536))
+                molecules = enumerate(Chem.ForwardSDMolSupplier(sdf_stream, removeHs=False))
+            else:
+                # Only process successful ligands: the supplier is indexed, so only the selected
+                # records get parsed and the others are merely skipped over
+                suppl = Chem.SDMolSupplier(sdf_file, removeHs=False)
+                total_processed = len(suppl)
+                molecules = ((i, suppl[i]) for i in sorted(i for i in success_ids if 0 <= i < total_processed))
             
-            # Validate molecule structure
-            is_valid, reason = is_valid_molecule(mol)
+            for i, mol in molecules:
+                if success_ids is None:
+                    total_processed += 1
+                
+                # Validate molecule structure
+                is_valid, reason = is_valid_molecule(mol)
             
-            if not is_valid:
-                log("WARN", f"Skipping ligand {i}: {reason}")
-                continue
+                if not is_valid:
+                    log("WARN", f"Skipping ligand {i}: {reason}")
+                    continue
                 
-            valid_structures += 1
+                valid_structures += 1
             
-            # Create individual PDB file for this ligand (not SDF)
-            ligand_file = os.path.join(output_dir, f"ligand_{i}.pdb")
+                # Create individual PDB file for this ligand (not SDF)
+                ligand_file = os.path.join(output_dir, f"ligand_{i}.pdb")
             
-            # Convert SDF to PDB using RDKit
-            try:
-                Chem.MolToPDBFile(mol, ligand_file)
-                ligand_files.append((i, ligand_file))
-                if DEBUG_MODE:
-                    log("DEBUG", f"Extracted valid ligand {i} to {ligand_file}")
-            except Exception as e:
-                log("WARN", f"Failed to convert molecule {i} to PDB: {e}")
-                continue
+                # Convert SDF to PDB using RDKit
+                try:
+                    MolToPDBFile(mol, ligand_file)
+                    ligand_files.append((i, ligand_file))
+                    if DEBUG_MODE:
+                        log("DEBUG", f"Extracted valid ligand {i} to {ligand_file}")
+                except Exception as e:
+                    log("WARN", f"Failed to convert molecule {i} to PDB: {e}")
+                    continue
         
         log("INFO", f"Processed {total_processed} total structures")
         log("INFO", f"Found {valid_structures} valid structures")
@@ -152,53 +319,55 @@ def split_multiligand_sdf(sdf_file, output_dir, success_ids=None):
         
         return ligand_files
         
+    except FileNotFoundError:
+        log("ERROR", f"Multi-ligand SDF file not found: {sdf_file}")
+        return []
     except Exception as e:
         log("ERROR", f"Failed to split multi-ligand SDF: {e}")
         return []
 
+# Path to Delta LinF9
+DELTA_LINF9_DIR = "/vol/data/drug-design-pipeline/external/deltalinf9"
+DELTA_LINF9_SCRIPT = os.path.join(DELTA_LINF9_DIR, "script", "runXGB.py")
+
+# XGB score line printed by runXGB.py, e.g. "XGB (in pK) :  6.123"
+_XGB_RE = re.compile(r'XGB \(in pK\)\s*:\s*([0-9.\-]+)')
+
+def parse_xgb_output(stdout):
+    """Parse the XGB score from the runXGB.py output"""
+    # Debug: show raw output
+    if DEBUG_MODE:
+        log("DEBUG", f"Delta LinF9 raw output: {stdout}")
+    
+    xgb_match = _XGB_RE.search(stdout)
+    if xgb_match:
+        xgb_score = float(xgb_match.group(1))
+        if DEBUG_MODE:
+            log("DEBUG", f"Parsed XGB score: {xgb_score}")
+        return xgb_score, stdout
+    else:
+        log("WARN", "Could not parse XGB score from output")
+        log("WARN", f"Raw output was: {stdout}")
+        return None, stdout
+
 def run_delta_linf9(protein_file, ligand_file, timeout=300):
     """Run Delta LinF9 on a single ligand"""
     
-    # Path to Delta LinF9
-    delta_linf9_dir = "/vol/data/drug-design-pipeline/external/deltalinf9"
-    script_path = os.path.join(delta_linf9_dir, "script", "runXGB.py")
-    
     # Convert to absolute paths
     protein_file = os.path.abspath(protein_file)
     ligand_file = os.path.abspath(ligand_file)
     
     try:
-        # Change to Delta LinF9 directory
-        original_dir = os.getcwd()
-        os.chdir(delta_linf9_dir)
-        
         # Use the current Python executable (should be from the correct conda environment)
-        import sys
         python_executable = sys.executable
         
-        # Run the script
-        cmd = [python_executable, script_path, protein_file, ligand_file]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
-        
-        # Change back to original directory
-        os.chdir(original_dir)
+        # Run the script from the Delta LinF9 directory; cwd= only applies to the child,
+        # so several ligands can be scored at once from different threads
+        cmd = [python_executable, DELTA_LINF9_SCRIPT, protein_file, ligand_file]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout, cwd=DELTA_LINF9_DIR)
         
         if result.returncode == 0:
-            # Debug: show raw output
-            if DEBUG_MODE:
-                log("DEBUG", f"Delta LinF9 raw output: {result.stdout}")
-            
-            # Parse XGB score from output
-            xgb_match = re.search(r'XGB \(in pK\) :\s*([0-9.-]+)', result.stdout)
-            if xgb_match:
-                xgb_score = float(xgb_match.group(1))
-                if DEBUG_MODE:
-                    log("DEBUG", f"Parsed XGB score: {xgb_score}")
-                return xgb_score, result.stdout
-            else:
-                log("WARN", "Could not parse XGB score from output")
-                log("WARN", f"Raw output was: {result.stdout}")
-                return None, result.stdout
+            return parse_xgb_output(result.stdout)
         else:
             log("ERROR", f"Delta LinF9 failed: {result.stderr}")
             return None, result.stderr
@@ -210,124 +379,236 @@ def run_delta_linf9(protein_file, ligand_file, timeout=300):
         log("ERROR", f"Delta LinF9 execution failed: {e}")
         return None, str(e)
 
-def process_equibind_output(equibind_dir, protein_file, output_dir, max_ligands=None):
+# Working directory of the parent process, used to resolve relative paths in the workers
+_CALLER_DIR = None
+# Scoring function of an importable runXGB module (loaded once per worker), if it has one
+_XGB_SCORER = None
+
+def init_delta_linf9_worker(caller_dir):
+    """Prepare a worker process for run_delta_linf9_inprocess"""
+    global _CALLER_DIR, _XGB_SCORER
+    _CALLER_DIR = caller_dir
+    # runXGB.py resolves its model files relative to the Delta LinF9 directory;
+    # a worker only ever runs Delta LinF9, so changing its directory once is safe
+    os.chdir(DELTA_LINF9_DIR)
+    sys.path.insert(0, os.path.dirname(DELTA_LINF9_SCRIPT))
+    
+    # Versions of runXGB.py that define run_XGB(protein, ligand) behind a __main__ guard can be
+    # imported once and called directly; anything else is run as a script per ligand
+    argv = sys.argv
+    sys.argv = [DELTA_LINF9_SCRIPT]
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            import runXGB
+        if callable(getattr(runXGB, 'run_XGB', None)):
+            _XGB_SCORER = runXGB.run_XGB
+    except BaseException:
+        # an unguarded script exits or fails when imported without ligand arguments
+        _XGB_SCORER = None
+    finally:
+        sys.argv = argv
+
+def run_delta_linf9_inprocess(protein_file, ligand_file, timeout=None):
+    """Run Delta LinF9 on a single ligand inside the current worker process
+    
+    runXGB.run_XGB is called directly when the worker could import it; otherwise runXGB.py is
+    executed as __main__ in this interpreter. Either way the interpreter start-up and the imports of
+    its dependencies are paid once per worker instead of once per ligand. The timeout is not enforced.
+    """
+    # relative to the directory the pipeline was started from, not the worker's
+    protein_file = os.path.join(_CALLER_DIR, protein_file)
+    ligand_file = os.path.join(_CALLER_DIR, ligand_file)
+    
+    if _XGB_SCORER is not None:
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                xgb_score = float(_XGB_SCORER(protein_file, ligand_file))
+        except Exception as e:
+            log("ERROR", f"Delta LinF9 execution failed: {e}")
+            return None, str(e)
+        if DEBUG_MODE:
+            log("DEBUG", f"Delta LinF9 XGB score: {xgb_score}")
+        return xgb_score, output.getvalue()
+    
+    output = io.StringIO()
+    argv = sys.argv
+    sys.argv = [DELTA_LINF9_SCRIPT, protein_file, ligand_file]
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            runpy.run_path(DELTA_LINF9_SCRIPT, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            log("ERROR", f"Delta LinF9 failed: {output.getvalue()}")
+            return None, output.getvalue()
+    except Exception as e:
+        log("ERROR", f"Delta LinF9 execution failed: {e}")
+        return None, str(e)
+    finally:
+        sys.argv = argv
+    
+    return parse_xgb_output(output.getvalue())
+
+def score_ligand(protein_file, ligand_file, scorer=run_delta_linf9):
+    """Run Delta LinF9 on one ligand and return its XGB score (None on failure) and processing time"""
+    start_time = time.time()
+    xgb_score, output = scorer(protein_file, ligand_file)
+    return xgb_score, time.time() - start_time
+
+def remove_file(path):
+    """Delete a file, ignoring files that are already gone or cannot be removed"""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def write_results_csv(df, results_file):
+    """Write a results frame with polars' multithreaded CSV writer if available"""
+    if pl is not None:
+        try:
+            # same output as the pandas fallback: NaN scores as empty fields, 4 decimals
+            pl.from_pandas(df).write_csv(results_file, float_precision=4)
+            return
+        except Exception as e:
+            # Best effort: e.g. from_pandas needs pyarrow for the categorical status column, old polars has no
+            # float_precision; the scores are never lost to the faster writer, pandas writes the file instead
+            log("DEBUG", f"polars CSV writer failed, using pandas: {e}")
+    df.to_csv(results_file, index=False, float_format='%.4f')
+
+def process_equibind_output(equibind_dir, protein_file, output_dir, max_ligands=None, jobs=None, in_process=False,
+                            validate=True, top_k=10):
     """Process all EquiBind output ligands through Delta LinF9"""
     
     ligands_dir = os.path.join(equibind_dir, "ligands")
     success_file = os.path.join(ligands_dir, "success.txt")
     multiligand_sdf = os.path.join(ligands_dir, "output.sdf")
     
-    # Validate inputs
-    if not os.path.exists(ligands_dir):
-        log("ERROR", f"Ligands directory not found: {ligands_dir}")
-        return False
-        
-    if not os.path.exists(multiligand_sdf):
-        log("ERROR", f"Multi-ligand SDF file not found: {multiligand_sdf}")
-        return False
-        
-    if not os.path.exists(protein_file):
+    # Validate inputs; the protein is only opened by Delta LinF9 itself, so check it up front
+    # instead of failing once per ligand (a missing output.sdf is reported by the split)
+    if not os.path.isfile(protein_file):
         log("ERROR", f"Protein file not found: {protein_file}")
         return False
     
     # Create output directory
     os.makedirs(output_dir, exist_ok=True)
     
-    # Create temporary directory for individual ligand files
-    temp_dir = os.path.join(output_dir, "temp_ligands")
-    os.makedirs(temp_dir, exist_ok=True)
+    # Create temporary directory for individual ligand files; in RAM-backed /dev/shm where
+    # available, since every ligand file is written once, read once by Delta LinF9 and deleted
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        temp_dir = tempfile.mkdtemp(prefix="temp_ligands_", dir="/dev/shm")
+    else:
+        temp_dir = os.path.join(output_dir, "temp_ligands")
+        os.makedirs(temp_dir, exist_ok=True)
     
-    # Read successful ligand IDs (if success file exists)
-    success_ids = None
-    if os.path.exists(success_file):
+    ligand_files = []
+    try:
+        # Read successful ligand IDs (if success file exists)
         success_ids = read_success_file(success_file)
-        log("INFO", f"Found {len(success_ids)} successful ligands in success.txt")
-    else:
-        log("WARN", "No success.txt file found, processing all ligands in output.sdf")
+        if success_ids is not None:
+            log("INFO", f"Found {len(success_ids)} successful ligands in success.txt")
+        else:
+            log("WARN", "No success.txt file found, processing all ligands in output.sdf")
     
-    # Split the multi-ligand SDF file
-    ligand_files = split_multiligand_sdf(multiligand_sdf, temp_dir, success_ids)
+        # Split the multi-ligand SDF file
+        ligand_files = split_multiligand_sdf(multiligand_sdf, temp_dir, success_ids, validate, jobs)
     
-    if not ligand_files:
-        log("ERROR", "No ligands found in the multi-ligand SDF file")
-        return False
+        if not ligand_files:
+            log("ERROR", "No ligands found in the multi-ligand SDF file")
+            return False
+    
+        # Limit number of ligands if specified
+        if max_ligands:
+            ligand_files = ligand_files[:max_ligands]
     
-    # Limit number of ligands if specified
-    if max_ligands:
-        ligand_files = ligand_files[:max_ligands]
+        log("INFO", f"Processing {len(ligand_files)} ligands through Delta LinF9")
     
-    log("INFO", f"Processing {len(ligand_files)} ligands through Delta LinF9")
+        # Each ligand is scored independently, so up to `jobs` of them run at once: either as
+        # runXGB.py child processes started from threads, or in-process in long-lived worker processes
+        n_ligands = len(ligand_files)
+        # Compact explicit dtypes: pK scores and timings need no double precision
+        ligand_ids = np.fromiter((ligand_id for ligand_id, _ in ligand_files), dtype=np.int32, count=n_ligands)
+        xgb_scores = np.full(n_ligands, np.nan, dtype=np.float32)
+        processing_times = np.empty(n_ligands, dtype=np.float32)
     
-    # Initialize results
-    results = []
+        if in_process:
+            executor = ProcessPoolExecutor(max_workers=jobs or os.cpu_count(),
+                                           initializer=init_delta_linf9_worker, initargs=(os.getcwd(),))
+            scorer = run_delta_linf9_inprocess
+        else:
+            executor = ThreadPoolExecutor(max_workers=jobs or os.cpu_count())
+            scorer = run_delta_linf9
     
-    # Process each ligand
-    for i, (ligand_id, ligand_file) in enumerate(ligand_files):
-        log("INFO", f"Processing ligand {ligand_id} ({i+1}/{len(ligand_files)})")
+        with executor:
+            futures = {executor.submit(score_ligand, protein_file, ligand_file, scorer): i
+                       for i, (_, ligand_file) in enumerate(ligand_files)}
         
-        start_time = time.time()
-        xgb_score, output = run_delta_linf9(protein_file, ligand_file)
-        processing_time = time.time() - start_time
+            for done, future in enumerate(as_completed(futures)):
+                i = futures[future]
+                xgb_score, processing_times[i] = future.result()
+            
+                if xgb_score is not None:
+                    xgb_scores[i] = xgb_score
+                    log("INFO", f"Ligand {ligand_ids[i]}: XGB score = {xgb_score:.3f} ({done+1}/{n_ligands})")
+                else:
+                    log("WARN", f"Failed to process ligand {ligand_ids[i]} ({done+1}/{n_ligands})")
+    
+        # Create DataFrame from the result columns and save results
+        df = pd.DataFrame({
+            'ligand_id': ligand_ids,
+            'ligand_file': [ligand_file for _, ligand_file in ligand_files],
+            'xgb_score': xgb_scores,
+            'processing_time': processing_times,
+            'status': pd.Categorical(np.where(np.isnan(xgb_scores), 'FAILED', 'SUCCESS'), categories=['SUCCESS', 'FAILED'])
+        })
+    
+        # Save all results
+        results_file = os.path.join(output_dir, "delta_linf9_results.csv")
+        write_results_csv(df, results_file)
+        log("INFO", f"Results saved to: {results_file}")
+    
+        # Create ranked results (only successful ones): rank the result arrays directly and
+        # stream the rows out with the csv module instead of copying and sorting a DataFrame
+        successful = np.flatnonzero(~np.isnan(xgb_scores))
+        ranked = successful[np.argsort(-xgb_scores[successful], kind='stable')].tolist()
+        ranked_file = os.path.join(output_dir, "ligands_ranked.csv")
+    
+        if ranked:
+            with open(ranked_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(df.columns)
+                writer.writerows((ligand_ids[i], ligand_files[i][1], f"{xgb_scores[i]:.4f}", f"{processing_times[i]:.4f}", 'SUCCESS')
+                                 for i in ranked)
+            log("INFO", f"Ranked results saved to: {ranked_file}")
         
-        if xgb_score is not None:
-            log("INFO", f"Ligand {ligand_id}: XGB score = {xgb_score:.3f}")
-            results.append({
-                'ligand_id': ligand_id,
-                'ligand_file': ligand_file,
-                'xgb_score': xgb_score,
-                'processing_time': processing_time,
-                'status': 'SUCCESS'
-            })
+            # Print top k results
+            print(f"\nTOP {top_k} LIGANDS BY XGB SCORE:")
+            print("-" * 60)
+            print(f"{'Rank':>4} | {'Ligand ID':>9} | {'XGB Score':>10} | {'Processing Time':>15}")
+            print("-" * 60)
+            print("\n".join(
+                f"{rank:4} | {ligand_ids[i]:9} | {xgb_scores[i]:10.3f} | {processing_times[i]:13.2f}s"
+                for rank, i in enumerate(ranked[:top_k], 1)))
         else:
-            log("WARN", f"Failed to process ligand {ligand_id}")
-            results.append({
-                'ligand_id': ligand_id,
-                'ligand_file': ligand_file,
-                'xgb_score': None,
-                'processing_time': processing_time,
-                'status': 'FAILED'
-            })
-    
-    # Create DataFrame and save results
-    df = pd.DataFrame(results)
-    
-    # Save all results
-    results_file = os.path.join(output_dir, "delta_linf9_results.csv")
-    df.to_csv(results_file, index=False)
-    log("INFO", f"Results saved to: {results_file}")
-    
-    # Create ranked results (only successful ones)
-    successful_df = df[df['status'] == 'SUCCESS'].copy()
-    ranked_file = os.path.join(output_dir, "ligands_ranked.csv")
-    
-    if len(successful_df) > 0:
-        successful_df = successful_df.sort_values('xgb_score', ascending=False)
-        successful_df.to_csv(ranked_file, index=False)
-        log("INFO", f"Ranked results saved to: {ranked_file}")
-        
-        # Print top 10 results
-        print(f"\nTOP 10 LIGANDS BY XGB SCORE:")
-        print("-" * 60)
-        print(f"{'Rank':>4} | {'Ligand ID':>9} | {'XGB Score':>10} | {'Processing Time':>15}")
-        print("-" * 60)
-        for idx, (_, row) in enumerate(successful_df.head(10).iterrows()):
-            print(f"{idx+1:4} | {row['ligand_id']:9} | {row['xgb_score']:10.3f} | {row['processing_time']:13.2f}s")
-    else:
-        # Create empty ranked file if no successful ligands
-        empty_df = pd.DataFrame(columns=['ligand_id', 'xgb_score', 'processing_time', 'status'])
-        empty_df.to_csv(ranked_file, index=False)
-        log("WARN", "No ligands were successfully processed")
-        log("INFO", f"Empty ranked results saved to: {ranked_file}")
-    
-    # Clean up temporary files
-    try:
-        import shutil
-        shutil.rmtree(temp_dir)
-        log("INFO", "Cleaned up temporary ligand files")
-    except Exception as e:
-        log("WARN", f"Could not clean up temporary files: {e}")
+            # Create empty ranked file if no successful ligands
+            empty_df = pd.DataFrame(columns=['ligand_id', 'xgb_score', 'processing_time', 'status'])
+            empty_df.to_csv(ranked_file, index=False)
+            log("WARN", "No ligands were successfully processed")
+            log("INFO", f"Empty ranked results saved to: {ranked_file}")
     
-    return True
+        
+        return True
+    finally:
+        # The temporary directory is removed on every exit path, errors and interrupts included,
+        # so no ligand files are left behind in RAM-backed /dev/shm. The ligand files are known,
+        # so they are unlinked concurrently (metadata round trips dominate on networked file systems)
+        # and rmtree removes whatever is left
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(remove_file, (ligand_file for _, ligand_file in ligand_files)))
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        if os.path.exists(temp_dir):
+            log("WARN", f"Could not clean up temporary files in {temp_dir}")
+        else:
+            log("INFO", "Cleaned up temporary ligand files")
 
 def main():
     global DEBUG_MODE
@@ -343,11 +624,23 @@ def main():
                        help='Maximum number of ligands to process (for testing)')
     parser.add_argument('-d', '--debug', action='store_true',
                        help='Enable debug output')
+    parser.add_argument('--top-k', type=int, default=10,
+                       help='Number of best-scoring ligands to print (default: 10)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                       help='Number of ligands to score (and split) at once (default: number of CPUs; the split of '
+                            'small SDF files is then done in this process)')
+    parser.add_argument('--in-process', action='store_true',
+                       help='Run runXGB.py inside long-lived worker processes instead of one new Python process per ligand '
+                            '(saves the interpreter start-up and imports, but the per-ligand timeout is not enforced)')
+    parser.add_argument('--skip-validation', action='store_true',
+                       help='Split output.sdf by its $$$$ delimiters without parsing it with RDKit; '
+                            'ligands are scored as SDF and not validated')
     
     args = parser.parse_args()
     
     # Set debug mode
     DEBUG_MODE = args.debug
+    logger.setLevel(logging.DEBUG if DEBUG_MODE else logging.INFO)
     
     log("INFO", "Starting EquiBind to Delta LinF9 processing")
     log("INFO", f"Input directory: {args.input}")
@@ -355,8 +648,10 @@ def main():
     log("INFO", f"Output directory: {args.output}")
     if args.max_ligands:
         log("INFO", f"Maximum ligands to process: {args.max_ligands}")
+    log("INFO", f"Parallel jobs: {args.jobs or os.cpu_count()}")
     
-    success = process_equibind_output(args.input, args.protein, args.output, args.max_ligands)
+    success = process_equibind_output(args.input, args.protein, args.output, args.max_ligands, jobs=args.jobs,
+                                      in_process=args.in_process, validate=not args.skip_validation, top_k=args.top_k)
     
     if success:
         log("INFO", "Processing completed successfully!")
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import pytest
+
+Chem = pytest.importorskip("rdkit.Chem")
+AllChem = pytest.importorskip("rdkit.Chem.AllChem")
+pytest.importorskip("torch")
+pytest.importorskip("dgl")
+
+from datasets import multiple_ligands
+
+
+BROKEN_RECORD = "broken\n  not a molblock\n\n  2  1  0  0  0  0  0  0  0  0999 V2000\nM  END\n$$$$\n"
+
+
+def write_sdf(path):
+    # four parsable ligands with a broken record in between
+    blocks = []
+    for i, smiles in enumerate(["CCO", "c1ccccc1", "CC(=O)O", "CCN"]):
+        mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+        AllChem.EmbedMolecule(mol, randomSeed=0)
+        mol.SetProp("_Name", f"lig{i}")
+        blocks.append(Chem.MolToMolBlock(mol) + "$$$$\n")
+    blocks.insert(2, BROKEN_RECORD)
+    path.write_text("".join(blocks))
+
+
+def load(path):
+    args = SimpleNamespace(dataset_params={}, use_rdkit_coords=False, device="cpu", n_workers_data_load=2)
+    ligands = multiple_ligands.Ligands(str(path), args)
+    return ligands.true_idx, ligands.names, ligands.failed_ligs
+
+
+@pytest.mark.skipif(multiple_ligands.MultithreadedSDMolSupplier is None,
+                    reason="RDKit without MultithreadedSDMolSupplier")
+def test_multithreaded_read_matches_sdmolsupplier(tmp_path, monkeypatch):
+    sdf = tmp_path / "ligands.sdf"
+    write_sdf(sdf)
+
+    multithreaded = load(sdf)
+    monkeypatch.setattr(multiple_ligands, "MultithreadedSDMolSupplier", None)
+    sequential = load(sdf)
+
+    assert multithreaded == sequential
+    assert sequential[0] == [0, 1, 3, 4]
+    assert [i for i, _ in sequential[2]] == [2]